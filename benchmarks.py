@@ -0,0 +1,382 @@
+"""
+Benchmarks for the ADV processing tools.
+
+Run this script to benchmark the processing of one instrument's data
+(it must already be processed, see `process_adv`). The memory
+benchmarks only work on Linux::
+
+    python benchmarks.py ttm01b-top
+
+The ``--synthetic`` benchmarks time each processing step on synthetic
+data of several lengths (see `synthetic`), so they do not need the
+real data. They write a JSON report (see `timing`), so that scaling
+regressions can be tracked::
+
+    python benchmarks.py --synthetic --hours 1 4 16 --report bench.json
+
+Both also check that the fused spectra match the TurbBinner spectra
+(see `bench_spectra`). ``--check-incremental`` checks that the
+incremental processing of an instrument's .vec file gives the same
+results as processing the whole file (see `check_incremental`)::
+
+    python benchmarks.py ttm01b-top --check-incremental
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+import resource
+from multiprocessing import Process, Queue
+import numpy as np
+import dolfyn.adv.api as avm
+from main import load, FILEINFO
+import process_adv
+import ttmlean
+import dattools as dtbx
+import synthetic
+import timing
+
+
+# The largest acceptable relative error of the fused spectra (they are
+# computed in single precision).
+spectra_tol = 1e-3
+
+# The largest acceptable relative difference between the incremental
+# and the full processing of a file (see `check_incremental`).
+incr_tol = 1e-3
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+def _relerr(a, b):
+    scale = np.nanmax(np.abs(b))
+    err = np.nanmax(np.abs(a - b))
+    if scale == 0:
+        return err
+    return err / scale
+
+
+def bench_spectra(dat, tol=spectra_tol):
+    """Compare the fused spectral engine (`spectra.FusedSpectra`) to
+    the separate TurbBinner spectra, for the data object `dat`.
+
+    Returns a dict of the maximum relative error of each spectrum, and
+    raises an exception if any of them is larger than `tol`.
+    """
+    bnr = avm.TurbBinner(n_bin=int(5 * 60 * dat.fs), fs=dat.fs)
+    bdats = {}
+    for fused, func in [(False, process_adv._calc_spectra),
+                        (True, process_adv._calc_spectra_fused)]:
+        bdat = bnr(dat)
+        _, dt = _timeit(func, bnr, dat, bdat)
+        bdats[fused] = bdat
+        print("  fused={}: {:.2f} s".format(fused, dt))
+    err = {}
+    for nm in ['Spec_velrot', 'Spec_velacc', 'Spec_velmot', 'Spec_velraw',
+               'Cspec_vel', 'Cspec_velmot', 'Cspec_velraw']:
+        err[nm] = _relerr(bdats[True][nm], bdats[False][nm])
+        print("  {:>14s} max. rel. error: {:.2e}".format(nm, err[nm]))
+    bad = [nm for nm in sorted(err) if not err[nm] <= tol]
+    if bad:
+        raise Exception("The fused spectra differ from the TurbBinner "
+                        "spectra: {}".format(', '.join(bad)))
+    return err
+
+
+def check_tripprod(n_bin=48, n_bins=5, fs=16., seed=0, tol=spectra_tol):
+    """Compare `process_adv.calc_tripprod` to the triple products of
+    ``TurbBinner.demean`` (as ``average`` used to calculate them), on
+    a small random velocity array.
+
+    Returns the maximum relative error, and raises an exception if it
+    is larger than `tol`.
+    """
+    vel = np.random.RandomState(seed).standard_normal(
+        (3, n_bin * n_bins + n_bin // 2)).astype(np.float32)
+    bnr = avm.TurbBinner(n_bin=n_bin, fs=fs)
+    turb = bnr.demean(vel)
+    ref = np.empty((3, 3, n_bins))
+    for i0 in range(3):
+        for i1 in range(3):
+            ref[i0, i1] = (turb[i0] ** 2 * turb[i1]).mean(-1)
+    # A TurbBinner's n_bin may be a float (e.g., ``5 * 60 * fs``).
+    err = _relerr(process_adv.calc_tripprod(vel, float(n_bin)), ref)
+    print("  tripprod max. rel. error: {:.2e}".format(err))
+    if not err <= tol:
+        raise Exception("calc_tripprod differs from the TurbBinner "
+                        "triple products.")
+    return err
+
+
+def check_sweep(dat, filt_freqs=None, tol=spectra_tol):
+    """Compare `ttmlean`'s filter sweep (`ttmlean.prepare_motion` and
+    `ttmlean.finish_motion`) to motion correcting `dat` separately for
+    each filter frequency (`ttmlean.correct_motion` and
+    ``earth2principal``, with the sweep's principal angle).
+
+    Returns the maximum relative error of the binned data of each
+    filter frequency, and raises an exception if any of them is
+    larger than `tol`.
+    """
+    if filt_freqs is None:
+        filt_freqs = ttmlean.filt_freqs
+    prep = ttmlean.prepare_motion(dat)
+    err = {}
+    for tag in sorted(filt_freqs):
+        datbd = ttmlean.bin(ttmlean.finish_motion(prep, filt_freqs[tag]))
+        ref = ttmlean.correct_motion(dat, filt_freqs[tag])
+        ref.props['principal_angle'] = prep[0].props['principal_angle']
+        avm.rotate.earth2principal(ref)
+        refbd = ttmlean.bin(ref)
+        err[tag] = max([_relerr(datbd[nm], refbd[nm]) for nm in
+                        ['vel', 'Spec', 'Spec_velraw', 'Spec_velacc',
+                         'Spec_velrot', 'Spec_velmoor', 'Spec_velmot']])
+        print("  sweep {:>4s} max. rel. error: {:.2e}".format(tag, err[tag]))
+    bad = [tag for tag in sorted(err) if not err[tag] <= tol]
+    if bad:
+        raise Exception("The ttmlean sweep differs from correct_motion: "
+                        "{}".format(', '.join(bad)))
+    return err
+
+
+class _TmpFinf(object):
+    # A file info object for the source file of `finf`, whose outputs
+    # are written to the directory `out_dir`.
+
+    def __init__(self, finf, out_dir):
+        self.fname = finf.fname
+        self.abs_source_fname = finf.abs_source_fname
+        self.abs_fname = os.path.join(out_dir, os.path.basename(finf.fname))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+
+def check_incremental(tag, tol=incr_tol):
+    """Compare the incremental processing (see
+    `process_adv._process_incremental`) of the .vec file of the
+    instrument `tag` to the processing of the whole file.
+
+    The outputs of both are written to a temporary directory. Every
+    time-series in the incremental ``_earth.h5`` and ``_earth_b5m.h5``
+    files is compared to the same time-steps of the full processing.
+
+    Returns a dict of the maximum relative difference of each
+    variable, and raises an exception if any of them is larger than
+    `tol`.
+    """
+    finf = FILEINFO[tag]
+    tmp_dir = tempfile.mkdtemp(prefix='check_incremental-')
+    try:
+        full = _TmpFinf(finf, os.path.join(tmp_dir, 'full'))
+        incr = _TmpFinf(finf, os.path.join(tmp_dir, 'incr'))
+        print("Full processing:")
+        drm = process_adv.correct_motion(process_adv._read_raw(full), full,
+                                         inplace=True)
+        bdat = process_adv.average(drm)
+        print("Incremental processing:")
+        process_adv._process_incremental(incr)
+        err = {}
+        for ext, ref in [('_earth.h5', drm), ('_earth_b5m.h5', bdat)]:
+            dat = avm.load(incr.abs_fname + ext)
+            n = dtbx.ntime(dat)
+            ref = dtbx.time_slice(ref, slice(0, n))
+            for nm, d in dat.iter():
+                if dtbx.time_axis(getattr(d, 'shape', ()), n) is None:
+                    continue
+                key = ext + ':' + nm
+                err[key] = _relerr(np.asarray(d, dtype=np.complex128),
+                                   np.asarray(ref[nm], dtype=np.complex128))
+                print("  {:>28s} max. rel. difference: {:.2e}"
+                      .format(key, err[key]))
+    finally:
+        shutil.rmtree(tmp_dir)
+    bad = [nm for nm in sorted(err) if not err[nm] <= tol]
+    if bad:
+        raise Exception("The incremental and full processing differ: {}"
+                        .format(', '.join(bad)))
+    return err
+
+
+def _rss_mb():
+    # The current resident set size of this process.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2. ** 20
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB (on Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10
+
+
+def _correct_motion_memory(tag, mode, queue):
+    dr = load(tag, coordsys='raw')
+    rss0 = _rss_mb()
+    if mode == 'copy':
+        drm = dr.copy()
+    elif mode == 'cow':
+        drm = dtbx.cow_copy(dr, process_adv._motion_vars(dr))
+    else:
+        drm = dr
+    process_adv.mc(drm)
+    queue.put((rss0, _peak_rss_mb()))
+
+
+def bench_correct_motion_memory(tag):
+    """Measure the peak memory use of motion correction, with a full
+    copy of the data ('copy'), a copy-on-write copy ('cow') and
+    in-place ('inplace').
+
+    Each mode runs in its own process. Returns a dict of the (memory
+    after loading, peak memory) [MB] of each mode.
+    """
+    out = {}
+    for mode in ['copy', 'cow', 'inplace']:
+        queue = Queue()
+        proc = Process(target=_correct_motion_memory,
+                       args=(tag, mode, queue))
+        proc.start()
+        out[mode] = queue.get()
+        proc.join()
+        print("  {:>8s}: loaded {:.0f} MB, peak {:.0f} MB"
+              .format(mode, *out[mode]))
+    return out
+
+
+def bench_storage(fname, profiles=None, n_read=50, window=4800):
+    """Compare the hdf5 storage profiles for the file `fname`.
+
+    For each profile this reports the time to write the file, its
+    size, and the average time to read `window` time-steps of ``vel``
+    at `n_read` random places in the file.
+    """
+    if profiles is None:
+        profiles = [prof for prof in sorted(dtbx.storage_profiles)
+                    if prof != 'blosc' or dtbx.hdf5plugin is not None]
+    out = {}
+    for prof in profiles:
+        tmp_fname = fname + '.bench-' + prof
+        _, t_write = _timeit(dtbx.repack, fname, prof, tmp_fname)
+        rdr = dtbx.H5Reader(tmp_fname)
+        i0s = np.random.randint(0, len(rdr) - window, n_read)
+        t0 = time.time()
+        for i0 in i0s:
+            rdr.read('vel', slice(i0, i0 + window))
+        t_read = (time.time() - t0) / n_read
+        rdr.close()
+        out[prof] = (t_write, os.path.getsize(tmp_fname) / 2. ** 20, t_read)
+        os.remove(tmp_fname)
+        print("  {:>8s}: write {:.1f} s, {:.0f} MB, read {:.1f} ms"
+              .format(prof, out[prof][0], out[prof][1],
+                      out[prof][2] * 1000))
+    return out
+
+
+def bench_synthetic(hours=(0.5, 2, 8), seed=0):
+    """Time the processing steps on synthetic data (see
+    `synthetic.make_data`) of each length in `hours`.
+
+    The steps are: cleaning the velocity (as in
+    `process_adv._read_raw`), `process_adv.correct_motion` (without
+    saving), `process_adv.average`, and ``ttmlean``'s motion correction
+    (the filter-independent part, and one filter frequency) and
+    `ttmlean.bin`. It also runs `check_tripprod` and `check_sweep`.
+
+    Returns the `timing` records of the steps (with an 'hours'
+    entry).
+    """
+    nrec = len(timing.records)
+    for hr in hours:
+        n0 = len(timing.records)
+        dat = synthetic.make_data(hr, seed=seed)
+        label = 'synthetic-{}h'.format(hr)
+        print("{} ({} points):".format(label, dtbx.ntime(dat)))
+
+        def stage(name):
+            return timing.stage(name, label)
+
+        with stage('clean'):
+            process_adv._clean_raw(dat)
+        with stage('motion'):
+            drm = dtbx.cow_copy(dat, process_adv._motion_vars(dat))
+            process_adv.mc(drm)
+        with stage('average'):
+            process_adv.average(drm)
+        print("Fused spectra:")
+        bench_spectra(drm)
+        check_tripprod()
+        drm = None
+        with stage('ttmlean_prepare'):
+            prep = ttmlean.prepare_motion(dat)
+        with stage('ttmlean_motion'):
+            datmc = ttmlean.finish_motion(prep, ttmlean.filt_freqs['10s'])
+        with stage('ttmlean_bin'):
+            ttmlean.bin(datmc)
+        prep = datmc = None
+        check_sweep(dat)
+        for rec in timing.records[n0:]:
+            rec['hours'] = hr
+    recs = timing.records[nrec:]
+    # Print the time per hour of data, to show how each step scales.
+    stages = []
+    for rec in recs:
+        if rec['stage'] not in stages:
+            stages.append(rec['stage'])
+    print("Wall time per hour of data [s]:")
+    print("  {:>16s}".format('hours') +
+          ''.join(['{:>9}'.format(hr) for hr in hours]))
+    for nm in stages:
+        print("  {:>16s}".format(nm) +
+              ''.join(['{:9.2f}'.format(rec['wall'] / rec['hours'])
+                       for rec in recs if rec['stage'] == nm]))
+    return recs
+
+
+def run(tag):
+    print("Motion correction memory use:")
+    bench_correct_motion_memory(tag)
+    print("Loading {}...".format(tag))
+    dat = load(tag, coordsys='earth')
+    print("Spectra:")
+    bench_spectra(dat)
+    print("Storage profiles:")
+    bench_storage(FILEINFO[tag].abs_fname + '_earth.h5')
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ADV processing tools.")
+    parser.add_argument(
+        'tag', nargs='?', default='ttm01b-top',
+        help="The instrument whose data is used (default: ttm01b-top).")
+    parser.add_argument(
+        '--synthetic', action='store_true',
+        help="Run the benchmarks on synthetic data instead.")
+    parser.add_argument(
+        '--check-incremental', action='store_true',
+        help="Check that the incremental processing of the instrument's "
+        ".vec file gives the same results as processing all of it.")
+    parser.add_argument(
+        '--hours', type=float, nargs='+', default=[0.5, 2, 8],
+        help="The lengths of the synthetic records (default: 0.5 2 8).")
+    parser.add_argument(
+        '--report', default=None,
+        help="The JSON report of the synthetic benchmarks (default: a "
+        "new file in ADV/timing/).")
+    args = parser.parse_args()
+    if args.check_incremental:
+        check_incremental(args.tag)
+    elif args.synthetic:
+        recs = bench_synthetic(args.hours)
+        print("Report: {}".format(
+            timing.save_report(args.report, 'benchmarks',
+                               info={'hours': args.hours}, recs=recs)))
+    else:
+        run(args.tag)
@@ -0,0 +1,442 @@
+#!/usr/bin/python
+"""
+A catalog of the data files of all of the deployments.
+
+The catalog (``ADV/catalog.json``) lists each instrument in
+`main.FILEINFO`, its metadata (``time_range``, ``latlon`` and
+``declination``, from its ``userdata.json`` file), and the processed
+files that exist. For each file it stores a compact time index, and
+the location and shape of each time-series variable, so that a
+query::
+
+    cat = catalog.load()
+    tr = ['2014-06-18 10:00', '2014-06-18 11:00']
+    sels = cat.query(tr, ['u'], coordsys='earth')
+    dats = cat.read(tr, ['u'], coordsys='earth')  # {tag: {name: array}}
+
+is resolved to the rows (and bytes, see `Selection.byte_ranges`) of
+each file, without opening the files that are outside of the time
+range, or reading the ``mpltime`` of the files that are.
+
+The time index of a file is a list of uniformly sampled segments,
+``[row0, mpltime0, n]``: the time of row ``row0 + k`` is within
+`tolerance` samples of ``mpltime0 + k / rate``. The exact first and
+last rows of a query are found by reading a few values of
+``mpltime`` at the ends of the range.
+
+The catalog is updated (by `load`) when files are added, removed or
+changed::
+
+    python catalog.py
+"""
+from __future__ import print_function
+import json
+import os.path as path
+import posixpath
+import h5py
+import numpy as np
+from main import FILEINFO, pkg_root
+import dattools as dtbx
+import filetools as ftbx
+import pax
+
+catalog_fname = pkg_root + 'ADV/catalog.json'
+
+# The processed files of each instrument (as in `process_adv`).
+outputs = {'raw': '.h5',
+           'earth': '_earth.h5',
+           'earth_b5m': '_earth_b5m.h5',
+           'pax_b5m': '_pax_b5m.h5', }
+
+# The metadata that is copied from the userdata.json files.
+userdata_keys = ['time_range', 'latlon', 'declination', 'time_zone']
+
+# The maximum difference between the times in a file and its time
+# index [samples].
+tolerance = 0.25
+
+
+def _output(coordsys, bin):
+    # The output (file) that holds `coordsys` data (see `main.load`).
+    if bin:
+        if coordsys not in ['earth', 'pax']:
+            raise Exception("Binned data is only stored in "
+                            "the 'earth' and 'pax' coordinate systems.")
+        return coordsys + '_b5m'
+    elif coordsys in ['pax', 'earth']:
+        return 'earth'
+    elif coordsys in ['raw']:
+        return 'raw'
+    raise Exception('Invalid coordsys specification.')
+
+
+def time_index(mpltime, rate, n_block=2 ** 16):
+    """The uniformly sampled segments (``[row0, mpltime0, n]``) of
+    `mpltime`, at `rate` [hz]."""
+    segments = []
+    n = len(mpltime)
+    row0 = 0
+    while row0 < n:
+        i0 = row0
+        while i0 < n:
+            i1 = min(i0 + n_block, n)
+            err = ((mpltime[i0:i1] - mpltime[row0]) * 86400 * rate -
+                   np.arange(i0 - row0, i1 - row0))
+            bad = np.nonzero(np.abs(err) > tolerance)[0]
+            if len(bad):
+                i0 += bad[0]
+                break
+            i0 = i1
+        segments.append([int(row0), float(mpltime[row0]),
+                         int(i0 - row0)])
+        row0 = i0
+    return segments
+
+
+def index_file(fname):
+    """The catalog entry (a dict) of the hdf5 data file `fname`."""
+    rdr = dtbx.H5Reader(fname)
+    try:
+        mpltime = rdr.mpltime
+        n = len(mpltime)
+        # Binned data is sampled at 1 / (bin length).
+        rate = rdr.fs
+        if n > 1:
+            dt = np.median(np.diff(mpltime)) * 86400
+            if abs(dt * rate - 1) > 0.01:
+                rate = 1. / dt
+        # The variables are found in the file itself, because
+        # ``avm.mmload`` (in H5Reader) reads the time variables (e.g.,
+        # mpltime) into memory.
+        names = {}
+        for nm, d in dtbx._walk(rdr.fd):
+            if not isinstance(d, h5py.Dataset):
+                continue
+            axis = dtbx.time_axis(d.shape, n)
+            if axis is None:
+                continue
+            names[posixpath.basename(nm)] = {
+                'path': d.name, 'shape': list(d.shape),
+                'dtype': d.dtype.str, 'axis': axis,
+                'group': posixpath.dirname(nm)}
+        entry = {'n': n, 'rate': float(rate),
+                 'start': float(mpltime[0]), 'stop': float(mpltime[-1]),
+                 'segments': time_index(mpltime, rate),
+                 'rotate_vars': sorted(rdr.dat.props.get('rotate_vars',
+                                                         [])),
+                 'vars': names, }
+    finally:
+        rdr.close()
+    return entry
+
+
+def _userdata(finf):
+    with open(finf.abs_fname + '.userdata.json') as f:
+        udat = json.load(f)
+    out = dict((ky, udat[ky]) for ky in userdata_keys if ky in udat)
+    if 'time_range' in out:
+        out['time_range'] = [float(t) for t in
+                             dtbx.to_mpltime(out['time_range'])]
+    return out
+
+
+class Catalog(object):
+    """The catalog of the data files (see `load`).
+
+    Attributes
+    ----------
+    instruments : dict
+       For each tag (e.g., 'ttm01b-top'): its 'deployment' (e.g.,
+       'ttm01b'), 'position' ('top' or 'bot'), 'userdata', and the
+       'files' (see `outputs`) that exist.
+    """
+
+    def __init__(self, instruments=None):
+        self.instruments = instruments or {}
+
+    def update(self, tags=None, workers=4):
+        """Update the entries of the instruments `tags` (default:
+        all of them). Files are only indexed if they are new or have
+        changed (according to their hash).
+
+        Returns True if anything changed.
+        """
+        if tags is None:
+            tags = sorted(FILEINFO.keys())
+        changed = False
+        fnames = []
+        for tag in tags:
+            finf = FILEINFO[tag]
+            inst = {'deployment': tag.split('-')[0],
+                    'position': tag.split('-')[1],
+                    'fname': finf.fname,
+                    'userdata': _userdata(finf),
+                    'files': self.instruments.get(tag, {}).get('files', {}), }
+            if inst != self.instruments.get(tag):
+                changed = True
+            self.instruments[tag] = inst
+            for out, ext in outputs.items():
+                if path.isfile(finf.abs_fname + ext):
+                    fnames.append((tag, out, finf.fname + ext))
+                elif inst['files'].pop(out, None) is not None:
+                    changed = True
+        hashes = ftbx.hash_files([pkg_root + fnm for tag, out, fnm in fnames],
+                                 workers)
+        for (tag, out, fnm), fhash in zip(fnames, hashes):
+            files = self.instruments[tag]['files']
+            if files.get(out, {}).get('sha') == fhash:
+                continue
+            print("Indexing {}...".format(fnm))
+            files[out] = index_file(pkg_root + fnm)
+            files[out].update(fname=fnm, sha=fhash)
+            changed = True
+        return changed
+
+    def save(self, fname=catalog_fname):
+        """Save the catalog to the JSON file `fname`."""
+        with open(fname, 'w') as f:
+            json.dump({'instruments': self.instruments}, f, indent=1,
+                      sort_keys=True)
+
+    def tags(self, tags=None):
+        """The instruments that match `tags` (tags, or deployments,
+        e.g., ['ttm01b']; default: all of them)."""
+        if tags is None:
+            return sorted(self.instruments.keys())
+        return sorted(tag for tag, inst in self.instruments.items()
+                      if tag in tags or inst['deployment'] in tags)
+
+    def query(self, time_range, names=None, coordsys='earth', bin=False,
+              tags=None):
+        """Find the data in `time_range`.
+
+        Parameters
+        ----------
+        time_range : 2-element iterable
+           The time range (mpltime values or date strings).
+        names : list of strings (optional)
+           The time-series variables (e.g., ['u'], or ['vel'];
+           default: all of them).
+        coordsys : {'raw', 'earth', 'pax'}
+           The coordinate system (see `main.load`).
+        bin : bool
+           Query the averaged data?
+        tags : list of strings (optional)
+           The instruments or deployments (default: all of them).
+
+        Returns
+        -------
+        selections : list of :class:`Selection`
+           One for each file that has data in `time_range`.
+        """
+        t0, t1 = dtbx.to_mpltime(time_range)
+        out_name = _output(coordsys, bin)
+        sels = []
+        for tag in self.tags(tags):
+            entry = self.instruments[tag]['files'].get(out_name)
+            if entry is None or entry['stop'] < t0 or entry['start'] >= t1:
+                continue
+            sel = Selection(tag, entry, coordsys, names)
+            with h5py.File(sel.fname, 'r') as fd:
+                ds = fd[entry['vars']['mpltime']['path']]
+                sel.rows = slice(_find_row(ds, entry, t0),
+                                 _find_row(ds, entry, t1))
+            if sel.rows.stop > sel.rows.start:
+                sels.append(sel)
+        return sels
+
+    def read(self, time_range, names=None, coordsys='earth', bin=False,
+             tags=None):
+        """Read the data in `time_range` (see `query`).
+
+        Returns a dict of the data (see `Selection.read`) of each
+        instrument.
+        """
+        return dict((sel.tag, sel.read())
+                    for sel in self.query(time_range, names, coordsys,
+                                          bin, tags))
+
+
+def _find_row(ds, entry, t):
+    # The first row of the file (with `mpltime` dataset `ds`) whose
+    # time is at or after `t` (like ``np.searchsorted``).
+    n = entry['n']
+    row = n
+    for row0, t_0, n_seg in entry['segments']:
+        k = int(np.ceil((t - t_0) * 86400 * entry['rate'] - tolerance))
+        if k < n_seg:
+            row = row0 + max(k, 0)
+            break
+    # The index is only accurate to within `tolerance`, so check
+    # the times around `row`.
+    i0, i1 = max(row - 2, 0), min(row + 2, n)
+    while True:
+        j = i0 + np.searchsorted(ds[i0:i1], t)
+        if (j > i0 or i0 == 0) and (j < i1 or i1 == n):
+            return int(j)
+        i0, i1 = max(2 * i0 - row, 0), min(2 * i1 - row, n)
+
+
+def _merge(ranges):
+    # Merge overlapping and adjacent (start, stop) ranges.
+    out = []
+    for start, stop in sorted(ranges):
+        if out and start <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], stop)
+        else:
+            out.append([start, stop])
+    return [tuple(rng) for rng in out]
+
+
+class Selection(object):
+    """The rows of a file that are in the time range of a query.
+
+    Attributes
+    ----------
+    tag : string
+       The instrument.
+    fname : string
+       The file.
+    rows : slice
+       The rows (time-indices) of the file.
+    names : list of strings
+       The variables.
+    """
+
+    def __init__(self, tag, entry, coordsys, names=None):
+        self.tag = tag
+        self.entry = entry
+        self.fname = pkg_root + entry['fname']
+        self.coordsys = coordsys
+        if names is None:
+            names = sorted(nm for nm in entry['vars'] if nm != 'mpltime')
+        self.names = list(names)
+        self.rows = slice(0, 0)
+
+    def __repr__(self, ):
+        return '<Selection: {} {}, rows {}:{}>'.format(
+            self.tag, self.entry['fname'], self.rows.start, self.rows.stop)
+
+    def _var(self, name):
+        # The catalog entry of the variable `name`, and the component
+        # (for aliases, e.g. 'u').
+        comp = None
+        if name not in self.entry['vars'] and name in dtbx.aliases:
+            name, comp = dtbx.aliases[name]
+        return self.entry['vars'][name], comp
+
+    def _rotate(self, name):
+        # Is `name` rotated into the principal frame when it is read?
+        var, comp = self._var(name)
+        return (self.coordsys == 'pax' and
+                self.entry['fname'].endswith(outputs['earth']) and
+                dtbx.aliases.get(name, (name, ))[0] in
+                self.entry['rotate_vars'] and len(var['shape']) == 2)
+
+    def byte_ranges(self, name):
+        """The (start, stop) byte ranges of the file that hold the
+        `rows` of the variable `name`.
+
+        For chunked datasets, these are the whole chunks (which are
+        compressed by some storage profiles, see
+        `dattools.storage_profiles`). Returns None if the location of
+        the data in the file is unknown (e.g., external storage).
+        """
+        var, comp = self._var(name)
+        if self._rotate(name):
+            comp = None
+        with h5py.File(self.fname, 'r') as fd:
+            ds = fd[var['path']]
+            ax = ds.ndim + var['axis']
+            if ds.chunks is None:
+                offset = ds.id.get_offset()
+                if offset is None:
+                    return None
+                # The bytes in each row, and the number of rows in
+                # each 'leading' index (e.g., component).
+                row_size = int(np.prod(ds.shape[ax + 1:])) * \
+                    ds.dtype.itemsize
+                n = ds.shape[ax]
+                leads = range(int(np.prod(ds.shape[:ax])))
+                if comp is not None:
+                    n_lead = int(np.prod(ds.shape[1:ax]))
+                    leads = range(comp * n_lead, (comp + 1) * n_lead)
+                return _merge(
+                    (offset + (lead * n + self.rows.start) * row_size,
+                     offset + (lead * n + self.rows.stop) * row_size)
+                    for lead in leads)
+            out = []
+            for ichunk in range(ds.id.get_num_chunks()):
+                info = ds.id.get_chunk_info(ichunk)
+                c0 = info.chunk_offset
+                if c0[ax] >= self.rows.stop or \
+                   c0[ax] + ds.chunks[ax] <= self.rows.start:
+                    continue
+                if comp is not None and not \
+                   c0[0] <= comp < c0[0] + ds.chunks[0]:
+                    continue
+                out.append((info.byte_offset,
+                            info.byte_offset + info.size))
+            return _merge(out)
+
+    def read(self, ):
+        """Read the `rows` of the variables.
+
+        Returns a dict of arrays, with ``mpltime``. For the 'pax'
+        `coordsys`, the vector variables of the earth-frame file are
+        rotated into the principal frame (see `pax.cached_angle`).
+        """
+        out = {}
+        with h5py.File(self.fname, 'r') as fd:
+            for name in ['mpltime'] + self.names:
+                var, comp = self._var(name)
+                ds = fd[var['path']]
+                indx = [slice(None)] * ds.ndim
+                indx[var['axis']] = self.rows
+                if comp is not None and not self._rotate(name):
+                    indx[0] = comp
+                    comp = None
+                d = ds[tuple(indx)]
+                if self._rotate(name):
+                    pax.rotate_vec(d, pax.cached_angle(self.fname))
+                if comp is not None:
+                    d = d[comp]
+                out[name] = d
+        return out
+
+
+def load(fname=catalog_fname, update=True):
+    """Load the catalog.
+
+    If `update` is True, the catalog is updated (see
+    `Catalog.update`), and saved if anything has changed.
+    """
+    cat = Catalog()
+    if path.isfile(fname):
+        with open(fname) as f:
+            cat = Catalog(json.load(f)['instruments'])
+    if update and cat.update():
+        cat.save(fname)
+    return cat
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Update the catalog of the data files.")
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help="Index every file again, even if it hasn't changed.")
+    args = parser.parse_args()
+    if args.rebuild:
+        cat = Catalog()
+        cat.update()
+        cat.save()
+    else:
+        cat = load()
+    for tag in cat.tags():
+        inst = cat.instruments[tag]
+        print("{}: {}".format(tag, ', '.join(sorted(inst['files'].keys()))
+                              or 'no processed files'))
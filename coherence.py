@@ -0,0 +1,341 @@
+#!/usr/bin/python
+"""
+Coherence and phase between pairs of ADVs.
+
+Each TTM carries a 'top' and a 'bot' ADV (0.5 m apart), and TTM01b
+and TTM02b were deployed at the same time. `coherence` aligns the
+``_earth.h5`` records of two instruments on their ``mpltime`` (bin by
+bin, see `align`), and computes the auto- and cross-spectra, the
+coherence and the phase between them in 5-minute bins. The files are
+read one block of bins at a time, and the two records are FFT'd
+together (by one `spectra.FusedSpectra`).
+
+The results are saved to
+``ADV/coherence/<tag_a>_<tag_b>_<coordsys>_b5m.h5``::
+
+    python coherence.py                          # All of the `pairs`
+    python coherence.py ttm01b-top:ttm01b-bot --jobs 2
+"""
+from __future__ import print_function
+import os
+import traceback
+import numpy as np
+from inspect import getsource
+from multiprocessing import Pool
+import dolfyn.adv.api as avm
+from main import FILEINFO, pkg_root
+import dattools as dtbx
+import filetools as ftbx
+import pax
+import spectra
+import timing
+
+# The pairs of instruments to compare: the top and bottom ADV of
+# each TTM, and the same ADV on the two TTMs that were deployed at
+# the same time.
+pairs = [('ttm01-top', 'ttm01-bot'),
+         ('ttm01b-top', 'ttm01b-bot'),
+         ('ttm02b-top', 'ttm02b-bot'),
+         ('ttm01b-top', 'ttm02b-top'),
+         ('ttm01b-bot', 'ttm02b-bot'), ]
+
+out_dir = pkg_root + 'ADV/coherence/'
+
+# The number of 5-minute bins to read at a time.
+bins_per_block = 12
+
+
+def _nearest(mpltime, t):
+    # The indices of the samples of `mpltime` nearest to the times `t`.
+    idx = np.searchsorted(mpltime, t).clip(1, len(mpltime) - 1)
+    before = (t - mpltime[idx - 1]) < (mpltime[idx] - t)
+    return idx - before
+
+
+def align(mpltime_a, mpltime_b, n_bin, fs):
+    """Align two records on their time, one bin at a time.
+
+    The bins follow each other in `a`, from the first time that is
+    in both records. Each bin is matched to the samples of `b` that
+    start at the sample nearest in time to its first sample, so that
+    the records stay aligned even if their clocks drift apart (`b`
+    skips or repeats a sample between bins).
+
+    Returns
+    -------
+    ia, ib : array of int
+       The first index of each bin in each record.
+    offset : array of float
+       The time of each bin of `b` minus that of `a` [seconds].
+
+    Raises an exception if the time difference of any sample of a
+    bin differs from its `offset` by more than half a sample (e.g.,
+    if one of the records has a gap).
+    """
+    i0a = np.searchsorted(mpltime_a, mpltime_b[0])
+    ia = np.arange(i0a, len(mpltime_a) - n_bin + 1, n_bin)
+    ib = _nearest(mpltime_b, mpltime_a[ia])
+    keep = ib + n_bin <= len(mpltime_b)
+    ia, ib = ia[keep], ib[keep]
+    if len(ia) == 0:
+        raise Exception("The records do not share a whole bin.")
+    offset = (mpltime_b[ib] - mpltime_a[ia]) * 86400
+    inds = np.arange(n_bin)
+    drift = ((mpltime_b[ib[:, None] + inds] -
+              mpltime_a[ia[:, None] + inds]) * 86400 - offset[:, None])
+    bad = np.nonzero(np.abs(drift).max(-1) > 0.5 / fs)[0]
+    if len(bad):
+        raise Exception("The records are not aligned in the bin that "
+                        "starts at mpltime {} (the time difference "
+                        "changes by {:.3f} s)."
+                        .format(mpltime_a[ia[bad[0]]],
+                                np.abs(drift[bad[0]]).max()))
+    return ia, ib, offset
+
+
+def coherence(fname_a, fname_b, coordsys='earth', n_fft_coh=None,
+              debias=True):
+    """Calculate the coherence between the velocity in two
+    earth-frame hdf5 files.
+
+    Parameters
+    ----------
+    fname_a, fname_b : string
+       The files.
+    coordsys : {'earth', 'pax'}
+       The coordinate system. For 'pax', both records are rotated into
+       the principal frame of `fname_a`, so that their components are
+       aligned.
+    n_fft_coh : int (optional)
+       The length of the FFT segments (default: 1/6 of a bin, as in
+       DOLfYN's ``TimeBinner``).
+    debias : bool
+       Remove the bias of the coherence due to the finite number of
+       segments (Benignus, 1969, as in DOLfYN's ``cohere``).
+
+    Returns
+    -------
+    dat : binned data object
+       With the mean velocity of each record (``vel_a``, ``vel_b``),
+       the time offset between them (``time_offset``, see `align`),
+       and their spectra (``Spec_a``, ``Spec_b``), cross-spectrum
+       (``Cspec``, ``a * conj(b)``), coherence (``coh``) and phase
+       (``phase``, radians; positive when `b` leads `a`), each with
+       shape ``(3, n_bins, n_freq)``.
+    """
+    rdra = dtbx.H5Reader(fname_a)
+    rdrb = dtbx.H5Reader(fname_b)
+    try:
+        fs = rdra.fs
+        if rdrb.fs != fs:
+            raise Exception("The files have different sample rates.")
+        n_bin = int(5 * 60 * fs)
+        ia, ib, offset = align(rdra.mpltime, rdrb.mpltime, n_bin, fs)
+        eng = spectra.FusedSpectra(n_bin, fs, n_fft_coh or n_bin // 6)
+        # The bins of the records are sampled `offset` seconds apart
+        # (less than half a sample), which shifts the phase by
+        # omega * offset.
+        shift = np.exp(1j * eng.omega * offset[:, None]).astype(np.complex64)
+        angle = None
+        if coordsys == 'pax':
+            angle = pax.cached_angle(fname_a)
+        out = dict((nm, []) for nm in ['mpltime', 'vel_a', 'vel_b',
+                                       'Spec_a', 'Spec_b', 'Cspec'])
+        inds = np.arange(n_bin)
+        for k0 in range(0, len(ia), bins_per_block):
+            blk = slice(k0, k0 + bins_per_block)
+            # The bins of `a` follow each other, but `b` may skip or
+            # repeat a sample between bins.
+            indx = slice(ia[blk][0], ia[blk][-1] + n_bin)
+            vel_b = rdrb.read('vel', slice(ib[blk][0], ib[blk][-1] + n_bin))
+            vel = np.stack([rdra.read('vel', indx),
+                            vel_b[:, ((ib[blk] - ib[blk][0])[:, None] +
+                                      inds).ravel()]])
+            if angle is not None:
+                for v in vel:
+                    pax.rotate_vec(v, angle)
+            fft_a, fft_b = eng.fft(vel)
+            out['mpltime'].append(rdra.mpltime[indx]
+                                  .reshape(-1, n_bin).mean(-1))
+            vel = vel.reshape(vel.shape[:-1] + (-1, n_bin)).mean(-1)
+            out['vel_a'].append(vel[0])
+            out['vel_b'].append(vel[1])
+            out['Spec_a'].append(eng.psd(fft_a))
+            out['Spec_b'].append(eng.psd(fft_b))
+            out['Cspec'].append(eng.csd(fft_a, fft_b) * shift[blk])
+        props = {'fs': fs,
+                 'n_bin': n_bin,
+                 'n_fft_coh': eng.n_fft,
+                 'n_seg': eng.n_seg,
+                 'coord_sys': 'principal' if angle is not None else 'earth',
+                 'fnames': [fname_a, fname_b],
+                 'time_range': [rdra.mpltime[ia[0]],
+                                rdra.mpltime[ia[-1] + n_bin - 1]], }
+        if angle is not None:
+            props['principal_angle'] = angle
+        dat = type(rdra.dat)()
+    finally:
+        rdra.close()
+        rdrb.close()
+    dat.props = props
+    out = dict((nm, np.concatenate(d, axis=-1 if d[0].ndim < 3 else -2))
+               for nm, d in out.items())
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coh = np.abs(out['Cspec']) ** 2 / (out['Spec_a'] * out['Spec_b'])
+    if debias:
+        coh = coh * (1 + 1. / eng.n_seg) - 1. / eng.n_seg
+    dat.add_data('mpltime', out['mpltime'], 'main')
+    dat.add_data('vel_a', out['vel_a'], 'main')
+    dat.add_data('vel_b', out['vel_b'], 'main')
+    dat.add_data('time_offset', offset.astype(np.float32), 'main')
+    dat.add_data('freq', eng.freq, 'spec')
+    dat.add_data('omega', eng.omega, 'spec')
+    dat.add_data('Spec_a', out['Spec_a'], 'spec')
+    dat.add_data('Spec_b', out['Spec_b'], 'spec')
+    dat.add_data('Cspec', out['Cspec'], 'spec')
+    dat.add_data('coh', coh.astype(np.float32), 'spec')
+    dat.add_data('phase', np.angle(out['Cspec'].conj()).astype(np.float32),
+                 'spec')
+    return dat
+
+
+def _fnames(pair):
+    return [FILEINFO[tag].abs_fname + '_earth.h5' for tag in pair]
+
+
+def out_fname(pair, coordsys='earth'):
+    """The output file of the instrument `pair`."""
+    return out_dir + '{}_{}_{}_b5m.h5'.format(pair[0], pair[1], coordsys)
+
+
+def load(pair, coordsys='earth'):
+    """Load the coherence of the instrument `pair` (e.g.,
+    ``('ttm01b-top', 'ttm01b-bot')``)."""
+    return avm.load(out_fname(pair, coordsys))
+
+
+def process_pair(pair, coordsys='earth', force=False):
+    """Calculate and save the coherence of the instrument `pair`.
+
+    This is skipped if the output is up to date, i.e., neither of
+    the ``_earth.h5`` files, nor the code, have changed since it was
+    saved.
+    """
+    fnames = _fnames(pair)
+    fname = out_fname(pair, coordsys)
+    angle = None
+    if coordsys == 'pax':
+        angle = pax.cached_angle(fnames[0])
+    key = ftbx.stage_key('coherence', coordsys, angle,
+                         [ftbx.cached_sha(fnm) for fnm in fnames],
+                         [getsource(coherence), getsource(align),
+                          getsource(_nearest),
+                          getsource(spectra.FusedSpectra)])
+    if not force and ftbx.stage_current(fname, key):
+        print("  {} is up to date.".format(fname))
+        return
+    print("Calculating the coherence of {} and {}...".format(*pair))
+    with timing.stage('coherence'):
+        dat = coherence(fnames[0], fnames[1], coordsys)
+    dat.props['pair'] = list(pair)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with timing.stage('save'):
+        dtbx.save(dat, fname, bins_per_block)
+    ftbx.stage_record(fname, key)
+
+
+def _run_one(job):
+    pair, coordsys, force = job
+    timing.current_file = '{}:{}'.format(*pair)
+    nrec = len(timing.records)
+    try:
+        process_pair(pair, coordsys, force)
+    except Exception:
+        msg = traceback.format_exc()
+        print(msg)
+        return pair, False, msg, timing.records[nrec:]
+    return pair, True, '', timing.records[nrec:]
+
+
+def run(pairs=pairs, coordsys='earth', workers=None, force=False,
+        report=None):
+    """Calculate the coherence of each of the instrument `pairs`.
+
+    Parameters
+    ----------
+    pairs : list of (tag, tag) tuples
+       The instrument pairs (default: all of `pairs`).
+    coordsys : {'earth', 'pax'}
+       The coordinate system (see `coherence`).
+    workers : int (optional)
+       The number of processes to spread the pairs over (default:
+       one pair after another in this process).
+    force : bool
+       Recompute the outputs even if they are up to date.
+    report : string or False
+       The JSON file to write the timing of each stage to (see
+       `timing.save_report`). False: don't write a report.
+
+    Returns
+    -------
+    summary : list of (pair, success, message) tuples
+    """
+    nrec = len(timing.records)
+    jobs = [(tuple(pair), coordsys, force) for pair in pairs]
+    if workers is None:
+        summary = [_run_one(job)[:3] for job in jobs]
+    else:
+        pool = Pool(workers)
+        try:
+            out = pool.map(_run_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        summary = []
+        for pair, ok, msg, recs in out:
+            summary.append((pair, ok, msg))
+            timing.records.extend(recs)
+    for pair, ok, msg in summary:
+        print("  {}:{}: {}".format(pair[0], pair[1],
+                                   'OK' if ok else 'FAILED'))
+    if report is not False:
+        report = timing.save_report(
+            report, 'coherence',
+            info={'pairs': [list(pair) for pair, ok, msg in summary],
+                  'coordsys': coordsys, 'workers': workers,
+                  'force': force},
+            recs=timing.records[nrec:])
+        print("Timing report: {}".format(report))
+    return summary
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Calculate the coherence between pairs of ADVs.")
+    parser.add_argument(
+        'pairs', nargs='*',
+        help="The instrument pairs, as <tag>:<tag> (e.g., "
+        "ttm01b-top:ttm01b-bot; default: all of them).")
+    parser.add_argument(
+        '--pax', action='store_true',
+        help="Compare the velocity in the principal frame (of the "
+        "first instrument) instead of the earth frame.")
+    parser.add_argument(
+        '--jobs', type=int, default=None,
+        help="The number of processes to use. By default the pairs "
+        "are processed one at a time.")
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Recompute the outputs even if they are up to date.")
+    parser.add_argument(
+        '--report', default=None,
+        help="The JSON file to write the timing of each stage to "
+        "(default: a new file in ADV/timing/).")
+    args = parser.parse_args()
+    run([tuple(pair.split(':')) for pair in args.pairs] or pairs,
+        'pax' if args.pax else 'earth', args.jobs, args.force,
+        args.report)
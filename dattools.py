@@ -0,0 +1,614 @@
+"""
+Tools for working with pieces of DOLfYN data objects.
+
+All of these functions identify 'time-series' variables as the
+arrays whose last dimension has the same length as ``mpltime``. In
+binned data, spectra (e.g., ``Spec``, with shape ``(3, n_bins,
+n_freq)``) are time-series along their second to last dimension.
+"""
+import copy
+import os
+import posixpath
+import time
+import numpy as np
+import h5py
+try:
+    # This registers the blosc filter with h5py.
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+from dateutil.parser import parse as parse_date
+import dolfyn.adv.api as avm
+from dolfyn.data.time import date2num
+
+# The hdf5 storage profiles (see `repack`). 'default' is DOLfYN's
+# layout. The other profiles store time-series in chunks along time,
+# which makes reading short time-ranges fast, optionally compressed
+# (with byte-shuffling, which helps compress float32 data). Files
+# compressed with 'blosc' can only be read if the `hdf5plugin`
+# package is imported.
+storage_profiles = {
+    'default': None,
+    'chunked': {},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+    'gzip': {'compression': 'gzip', 'compression_opts': 1,
+             'shuffle': True},
+    'blosc': {'blosc': True},
+}
+# The profile used by `save`. DOLfYN writes the 'default' layout
+# itself; the other profiles rewrite the file after it is saved, which
+# doubles the output I/O.
+storage_profile = 'default'
+
+# Variables that are components of other variables.
+aliases = {'u': ('vel', 0), 'v': ('vel', 1), 'w': ('vel', 2), }
+
+
+def time_axis(shape, n):
+    """The time axis (-1 or -2) of an array with `shape`, in a data
+    object with `n` time-steps (None if it is not a time-series)."""
+    if len(shape) > 0 and shape[-1] == n:
+        return -1
+    if len(shape) > 1 and shape[-2] == n:
+        return -2
+    return None
+
+
+def to_mpltime(time_range):
+    """Convert `time_range` (mpltime values or date strings) to
+    mpltime."""
+    return np.array([date2num(parse_date(t)) if isinstance(t, str) else t
+                     for t in time_range])
+
+
+def ntime(dat):
+    """The number of time-steps in `dat`."""
+    return len(dat['mpltime'])
+
+
+def iter_tseries(dat):
+    """Iterate over the (name, array) pairs of the time-series
+    variables in `dat`."""
+    n = ntime(dat)
+    for nm, d in dat.iter():
+        shape = getattr(d, 'shape', ())
+        if len(shape) > 0 and shape[-1] == n:
+            yield nm, d
+
+
+def preallocate(dat, n, dtype=np.float32):
+    """Replace the time-series variables in `dat` with (uninitialized)
+    arrays of length `n`.
+
+    float64 variables (except ``mpltime``) are allocated as `dtype`.
+    """
+    for nm, d in list(iter_tseries(dat)):
+        dt = d.dtype
+        if dt == np.float64 and nm != 'mpltime':
+            dt = dtype
+        dat[nm] = np.empty(d.shape[:-1] + (n, ), dtype=dt).view(type(d))
+    return dat
+
+
+def cow_copy(dat, names):
+    """Copy `dat`, sharing every array with `dat` except for the
+    variables in `names` (which are copied).
+
+    This is for functions that change only a few variables of `dat`
+    (e.g., motion correction), and should leave `dat` unchanged.
+    """
+    out = type(dat)()
+    out.props = copy.deepcopy(dat.props)
+    for grp, nms in dat.groups.items():
+        for nm in nms:
+            d = dat[nm]
+            if nm in names:
+                d = d.copy()
+            out.add_data(nm, d, grp)
+    return out
+
+
+def time_slice(dat, indx):
+    """A copy of `dat` with the time-indices `indx` (a slice) of its
+    time-series. The arrays are views of the arrays in `dat`."""
+    n = ntime(dat)
+    out = type(dat)()
+    out.props = copy.deepcopy(dat.props)
+    for grp, nms in dat.groups.items():
+        for nm in nms:
+            d = dat[nm]
+            axis = time_axis(getattr(d, 'shape', ()), n)
+            if axis == -1:
+                d = d[..., indx]
+            elif axis == -2:
+                d = d[..., indx, :]
+            out.add_data(nm, d, grp)
+    return out
+
+
+def concat(dats):
+    """Concatenate a list of binned data objects along their bin (time)
+    dimension.
+
+    The bin dimension is the last one, except for spectra (e.g.,
+    ``Spec``, with shape ``(3, n_bins, n_freq)``) where it is the
+    second to last one.
+    """
+    out = dats[0]
+    nb = ntime(out)
+    for nm, d in list(out.iter()):
+        axis = time_axis(getattr(d, 'shape', ()), nb)
+        if axis is None:
+            continue
+        out[nm] = np.concatenate([dat[nm] for dat in dats],
+                                 axis=axis).view(type(d))
+    return out
+
+
+def _filter_opts(profile):
+    opts = dict(storage_profiles[profile])
+    if opts.pop('blosc', False):
+        if hdf5plugin is None:
+            raise ImportError("The 'blosc' storage profile requires "
+                              "the hdf5plugin package.")
+        opts.update(hdf5plugin.Blosc(cname='lz4',
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return opts
+
+
+def repack(fname, profile, out_fname=None, n_chunk=4800):
+    """Rewrite the hdf5 file `fname` with a storage `profile` (one of
+    `storage_profiles`).
+
+    Parameters
+    ----------
+    fname : string
+       The hdf5 file.
+    profile : string
+       The storage profile.
+    out_fname : string (optional)
+       The file to write (default: replace `fname`).
+    n_chunk : int
+       The length of the time-series chunks (e.g., one 5-minute bin).
+       The time dimension of every time-series is also resizable (so
+       that data can be appended to it).
+    """
+    if storage_profiles[profile] is None and out_fname is None:
+        return
+    opts = {}
+    if storage_profiles[profile] is not None:
+        opts = _filter_opts(profile)
+    tmp_fname = (out_fname or fname) + '.tmp'
+    with h5py.File(fname, 'r') as src, h5py.File(tmp_fname, 'w') as dst:
+        n = [obj.shape[-1] for nm, obj in _walk(src)
+             if nm.split('/')[-1] == 'mpltime'][0]
+        for key, val in src.attrs.items():
+            dst.attrs[key] = val
+        for nm, obj in _walk(src):
+            axis = None
+            if isinstance(obj, h5py.Dataset) and \
+               obj.dtype.kind in 'iufc':
+                axis = time_axis(obj.shape, n)
+            if isinstance(obj, h5py.Group):
+                grp = dst.require_group(nm)
+                for key, val in obj.attrs.items():
+                    grp.attrs[key] = val
+            elif axis is None or storage_profiles[profile] is None:
+                parent = dst.require_group(posixpath.dirname(nm) or '/')
+                src.copy(obj, parent, name=posixpath.basename(nm))
+            else:
+                chunks = list(obj.shape)
+                chunks[axis] = min(n_chunk, n)
+                maxshape = list(obj.shape)
+                maxshape[axis] = None
+                ds = dst.create_dataset(nm, shape=obj.shape,
+                                        dtype=obj.dtype,
+                                        chunks=tuple(chunks),
+                                        maxshape=tuple(maxshape), **opts)
+                for i0 in range(0, n, n_chunk):
+                    sl = [slice(None)] * obj.ndim
+                    sl[axis] = slice(i0, i0 + n_chunk)
+                    ds[tuple(sl)] = obj[tuple(sl)]
+                for key, val in obj.attrs.items():
+                    ds.attrs[key] = val
+    os.rename(tmp_fname, out_fname or fname)
+
+
+def _walk(grp, prefix=''):
+    # Iterate over the (name, object) pairs in an hdf5 group,
+    # parents before children.
+    for nm, obj in grp.items():
+        yield prefix + nm, obj
+        if isinstance(obj, h5py.Group):
+            for item in _walk(obj, prefix + nm + '/'):
+                yield item
+
+
+def save(dat, fname, n_chunk=4800, profile=None, **kwargs):
+    """Save `dat` to the hdf5 file `fname`, with a storage `profile`
+    (default: `storage_profile`, see `repack`). `kwargs` are passed
+    to ``dat.save``."""
+    dat.save(fname, **kwargs)
+    repack(fname, profile or storage_profile, n_chunk=n_chunk)
+
+
+def _tseries_datasets(fd):
+    # The (dataset, time axis) pairs of the time-series in the open
+    # hdf5 file `fd`, and the number of time-steps in it.
+    objs = list(_walk(fd))
+    n = [obj.shape[-1] for nm, obj in objs
+         if nm.split('/')[-1] == 'mpltime'][0]
+    out = []
+    for nm, obj in objs:
+        if isinstance(obj, h5py.Dataset) and obj.dtype.kind in 'iufc':
+            axis = time_axis(obj.shape, n)
+            if axis is not None:
+                out.append((obj, axis))
+    return out, n
+
+
+def _resize(ds, axis, n):
+    if ds.maxshape[axis] is not None:
+        raise ValueError("The time dimension of '{}' in '{}' is not "
+                         "resizable (it was saved with the 'default' "
+                         "storage profile)."
+                         .format(ds.name, ds.file.filename))
+    shape = list(ds.shape)
+    shape[axis] = n
+    ds.resize(tuple(shape))
+
+
+def append(dat, fname, n_chunk=4800, **kwargs):
+    """Append the time-series of `dat` to the hdf5 file `fname`.
+
+    The file must have the same variables as `dat`, and have been
+    saved with a chunked storage profile (see `repack`). If `fname`
+    does not exist, `dat` is saved to it (see `save`, `kwargs` are
+    passed to it), with the 'chunked' profile if `storage_profile` is
+    'default'.
+    """
+    if not os.path.isfile(fname):
+        profile = storage_profile
+        if storage_profiles[profile] is None:
+            # Only the chunked time-series can be resized.
+            profile = 'chunked'
+        save(dat, fname, n_chunk, profile, **kwargs)
+        return
+    n_new = ntime(dat)
+    with h5py.File(fname, 'r+') as fd:
+        dsets, n = _tseries_datasets(fd)
+        for ds, axis in dsets:
+            _resize(ds, axis, n + n_new)
+            sl = [slice(None)] * ds.ndim
+            sl[axis] = slice(n, n + n_new)
+            ds[tuple(sl)] = np.asarray(dat[ds.name.split('/')[-1]])
+
+
+def truncate(fname, n):
+    """Truncate the time-series in the hdf5 file `fname` (if it
+    exists) to their first `n` time-steps."""
+    if not os.path.isfile(fname):
+        return
+    with h5py.File(fname, 'r+') as fd:
+        dsets, n0 = _tseries_datasets(fd)
+        if n0 <= n:
+            return
+        for ds, axis in dsets:
+            _resize(ds, axis, n)
+
+
+def mpltime2datetime64(mpltime, unit='ms'):
+    """Convert `mpltime` to numpy datetime64 values, with a precision
+    of `unit` ('s', 'ms' or 'us')."""
+    # mpltime is days since 0001-01-01 (plus one), so 1970-01-01 is
+    # 719163.
+    scale = {'s': 1, 'ms': 1e3, 'us': 1e6}[unit] * 86400
+    tm = np.round((np.asarray(mpltime) - 719163) * scale)
+    return tm.astype(np.int64).view('datetime64[' + unit + ']')
+
+
+def array_blocks(mpltime, columns, n_block=2 ** 16):
+    """Iterate over ``(mpltime, columns)`` blocks of `n_block` rows
+    of the arrays `mpltime` and `columns` (a list of arrays)."""
+    for i0 in range(0, len(mpltime), n_block):
+        sl = slice(i0, i0 + n_block)
+        yield mpltime[sl], [col[sl] for col in columns]
+
+
+def reader_blocks(reader, names, n_block=2 ** 16, indx=slice(None)):
+    """Iterate over ``(mpltime, columns)`` blocks of `n_block` rows
+    of the variables `names` (e.g., 'u', 'v', 'w') in the
+    :class:`H5Reader` `reader`. Only one block is read at a time."""
+    i0, i1, _ = indx.indices(len(reader))
+    for j0 in range(i0, i1, n_block):
+        sl = slice(j0, min(j0 + n_block, i1))
+        yield reader.mpltime[sl], [reader.read(nm, sl) for nm in names]
+
+
+def save_csv(fname, blocks, names, fmt='%0.3f', header=None,
+             time_unit='ms', delimiter=', '):
+    """Write the ``(mpltime, columns)`` `blocks` (see `array_blocks`
+    and `reader_blocks`) to the csv file `fname`, one block at a time.
+
+    The first column is the ISO 8601 time (with a precision of
+    `time_unit`, see `mpltime2datetime64`). `fmt` is the format of
+    the columns (one for all of them, or a list). `header` defaults
+    to the column `names`.
+    """
+    if isinstance(fmt, str):
+        fmt = [fmt] * len(names)
+    row_fmt = delimiter.join(['%s'] + list(fmt)) + '\n'
+    if header is None:
+        header = delimiter.join(['time'] + list(names))
+    with open(fname, 'w') as f:
+        f.write('# ' + header + '\n')
+        for mpltime, columns in blocks:
+            times = np.datetime_as_string(
+                mpltime2datetime64(mpltime, time_unit))
+            rows = zip(times.tolist(),
+                       *[np.asarray(col).tolist() for col in columns])
+            f.write(''.join([row_fmt % row for row in rows]))
+
+
+def save_parquet(fname, blocks, names, time_unit='ms'):
+    """Write the ``(mpltime, columns)`` `blocks` (see `save_csv`) to
+    the Parquet file `fname`, one row group per block.
+
+    This requires the pyarrow package.
+    """
+    if pyarrow is None:
+        raise ImportError("Writing Parquet files requires the "
+                          "pyarrow package.")
+    writer = None
+    try:
+        for mpltime, columns in blocks:
+            table = pyarrow.table(
+                [mpltime2datetime64(mpltime, time_unit)] +
+                [np.asarray(col) for col in columns],
+                names=['time'] + list(names))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(fname, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+# The MATLAB classes of numpy dtypes.
+_mat_classes = {'f8': 'double', 'f4': 'single',
+                'i1': 'int8', 'i2': 'int16', 'i4': 'int32', 'i8': 'int64',
+                'u1': 'uint8', 'u2': 'uint16', 'u4': 'uint32',
+                'u8': 'uint64', 'b1': 'logical', }
+
+
+def _mat_header():
+    # The 128-byte header of a MATLAB v7.3 file (it is written to the
+    # hdf5 'userblock'): descriptive text, the subsystem data offset,
+    # the version (0x0200) and the endian indicator.
+    txt = ('MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} '
+           'HDF5 schema 1.00 .'
+           .format(time.strftime('%a %b %d %H:%M:%S %Y')))
+    return (txt.ljust(116).encode('ascii') + b'\x00' * 8 +
+            b'\x00\x02' + b'IM')
+
+
+def save_mat73(dat, fname, groups=None, extra=None, n_chunk=2 ** 18):
+    """Save `dat` to the MATLAB v7.3 (hdf5-based) file `fname`.
+
+    Time-series are written `n_chunk` time-steps at a time, so that
+    the export never holds more than a chunk of any variable in
+    memory beyond `dat` itself.
+
+    Parameters
+    ----------
+    dat : DOLfYN data object
+       The data to save.
+    groups : list of strings (optional)
+       The data groups to save (default: all of them).
+    extra : dict (optional)
+       Additional time-series variables that are computed as they are
+       written: ``{name: func}``, where ``func(indx)`` returns the
+       variable at the time-indices `indx` (e.g., ``datenum``).
+    n_chunk : int
+       The number of time-steps written at a time.
+
+    Notes
+    -----
+    Arrays are stored transposed (and 1-D arrays as row vectors), so
+    that they have the same shape in MATLAB as in a ``save_mat``
+    file.
+    """
+    n = ntime(dat)
+    names = [nm for grp in (groups or dat.groups)
+             for nm in dat.groups[grp]]
+    extra = extra or {}
+    with h5py.File(fname, 'w', userblock_size=512) as fd:
+        for nm in names + sorted(extra):
+            if nm in extra:
+                func = extra[nm]
+                d = func(slice(0, 1))
+                shape = d.shape[:-1] + (n, )
+            else:
+                d = np.asarray(dat[nm])
+                shape = d.shape
+            if d.dtype.str[1:] not in _mat_classes:
+                continue
+            # MATLAB stores logical arrays as uint8.
+            dtype = np.uint8 if d.dtype.kind == 'b' else d.dtype
+            shape = (1, ) * (2 - len(shape)) + shape
+            axis = time_axis(shape, n)
+            chunks = None
+            if axis == -1:
+                chunks = (min(n_chunk, n), ) + shape[-2::-1]
+            ds = fd.create_dataset(nm, shape=shape[::-1],
+                                   dtype=dtype, chunks=chunks)
+            ds.attrs['MATLAB_class'] = np.bytes_(
+                _mat_classes[d.dtype.str[1:]])
+            if axis != -1:
+                ds[()] = d.reshape(shape).T
+                continue
+            for i0 in range(0, n, n_chunk):
+                sl = slice(i0, min(i0 + n_chunk, n))
+                if nm in extra:
+                    blk = func(sl)
+                else:
+                    blk = d[..., sl]
+                ds[sl] = blk.reshape(shape[:-1] + (-1, )).T
+    with open(fname, 'r+b') as f:
+        f.write(_mat_header())
+
+
+class H5Reader(object):
+    """Read pieces of a DOLfYN hdf5 data file.
+
+    Only the variables and the time-range that are requested are read
+    from the file. ``mpltime`` is read when the file is opened.
+
+    Parameters
+    ----------
+    fname : string
+       The hdf5 file to read.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        # Memory-map load the file to get its structure (the data
+        # groups, props and config); the data itself is read from
+        # `self.fd`.
+        self.dat = avm.mmload(fname)
+        self.fd = h5py.File(fname, 'r')
+        self.mpltime = self.read('mpltime')
+
+    def __len__(self, ):
+        return len(self.mpltime)
+
+    @property
+    def fs(self, ):
+        return self.dat.props['fs']
+
+    def close(self, ):
+        self.fd.close()
+
+    def read(self, name, indx=slice(None)):
+        """Read the time-indices `indx` of the variable `name`.
+
+        Variables that are not time-series are read in full.
+        """
+        if name in aliases and name not in self.dat:
+            name, comp = aliases[name]
+            return self.read(name, indx)[comp]
+        d = self.dat[name]
+        if isinstance(d, h5py.Dataset):
+            d = self.fd[d.name]
+        axis = time_axis(getattr(d, 'shape', ()), len(self.dat['mpltime']))
+        if axis == -1:
+            return np.asarray(d[..., indx])
+        elif axis == -2:
+            return np.asarray(d[..., indx, :])
+        return np.asarray(d[()])
+
+    def index(self, time_range):
+        """The slice of this file that is within `time_range` (mpltime
+        values or date strings)."""
+        i0, i1 = np.searchsorted(self.mpltime, to_mpltime(time_range))
+        return slice(i0, i1)
+
+    def block(self, indx, names=None):
+        """Read the time-indices `indx` of the file into a data object.
+
+        Parameters
+        ----------
+        indx : slice
+           The time indices to read.
+        names : list of strings (optional)
+           The time-series variables to read (default: all of them).
+           Variables that are not time-series are always read.
+        """
+        if names is not None:
+            names = [aliases.get(nm, (nm, ))[0] for nm in names]
+        n = len(self)
+        out = type(self.dat)()
+        out.props = copy.deepcopy(self.dat.props)
+        for grp, nms in self.dat.groups.items():
+            for nm in nms:
+                if time_axis(getattr(self.dat[nm], 'shape', ()), n) and \
+                   names is not None and nm != 'mpltime' and \
+                   nm not in names:
+                    continue
+                out.add_data(nm, self.read(nm, indx), grp)
+        return out
+
+    def blocks(self, n_block, names=None, n_max=None):
+        """Iterate over the file in blocks of `n_block` time-steps.
+
+        Only the first `n_max` time-steps are read (default: all).
+        """
+        if n_max is None:
+            n_max = len(self)
+        for i0 in range(0, n_max, n_block):
+            yield self.block(slice(i0, min(i0 + n_block, n_max)), names)
+
+
+class LazyData(object):
+    """A view of (a time-range of) a DOLfYN hdf5 file.
+
+    Variables are read from the file when they are first accessed, as
+    items or attributes (e.g., ``dat['vel']`` or ``dat.u``).
+
+    Parameters
+    ----------
+    reader : :class:`H5Reader`
+       The file.
+    indx : slice
+       The time-indices of the view.
+    names : list of strings (optional)
+       The time-series variables that are available (default: all).
+    """
+
+    def __init__(self, reader, indx=slice(None), names=None):
+        self._reader = reader
+        self._indx = indx
+        self._names = names
+        self._cache = {'mpltime': reader.mpltime[indx]}
+
+    @property
+    def props(self, ):
+        return self._reader.dat.props
+
+    def __contains__(self, name):
+        if self._names is not None and name != 'mpltime' and \
+           name not in self._names and \
+           aliases.get(name, (name, ))[0] not in self._names:
+            return False
+        return name in self._reader.dat or name in aliases
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if name in aliases and name not in self._reader.dat:
+            name, comp = aliases[name]
+            return self[name][comp]
+        if name not in self._cache:
+            self._cache[name] = self._read(name)
+        return self._cache[name]
+
+    def _read(self, name):
+        return self._reader.read(name, self._indx)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def load(self, ):
+        """Read all of the variables in this view into a DOLfYN data
+        object."""
+        return self._reader.block(self._indx, self._names)
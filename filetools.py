@@ -1,13 +1,33 @@
 import hashlib
-import shutil
+import json
+import os
+import threading
 import os.path as path
+from multiprocessing.pool import ThreadPool
 try:
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
 except:
-    from urllib import urlopen
+    from urllib2 import urlopen, Request, HTTPError
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
 
 pkg_root = path.dirname(path.realpath(__file__)) + '/'
 
+# The size, mtime, inode and hash of every file that has been hashed
+# by `cached_sha`. Threads share a lock, and the manifest is replaced
+# atomically (it is written to a temporary file first), so several
+# processes can use it at once: they may drop each other's new
+# entries (those files are just rehashed later), but the manifest is
+# never corrupted.
+manifest_fname = pkg_root + 'ADV/hash_manifest.json'
+_manifest_lock = threading.Lock()
+
+# os.replace overwrites the destination on every platform (Python 3);
+# Python 2's os.rename does on POSIX.
+_replace = getattr(os, 'replace', os.rename)
+
 
 def sha(fname):
     h = hashlib.sha256()
@@ -17,6 +37,86 @@ def sha(fname):
     return h.hexdigest()[:16]
 
 
+def _stat(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def _update_manifest(fname, digest):
+    with _manifest_lock:
+        manifest = _load_manifest()
+        manifest[path.realpath(fname)] = {'stat': _stat(fname),
+                                          'sha': digest}
+        tmp_fname = manifest_fname + '.{}.tmp'.format(os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(manifest, f, indent=0, sort_keys=True)
+        _replace(tmp_fname, manifest_fname)
+
+
+def _load_manifest():
+    if not path.isfile(manifest_fname):
+        return {}
+    with open(manifest_fname) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            # A damaged manifest only means that the files are rehashed.
+            return {}
+
+
+def cached_sha(fname, full=False):
+    """Return ``sha(fname)``.
+
+    The file is only hashed if its size, mtime or inode have changed
+    since it was last hashed (according to the manifest), or if
+    `full` is True.
+    """
+    entry = _load_manifest().get(path.realpath(fname))
+    if not full and entry is not None and entry['stat'] == _stat(fname):
+        return entry['sha']
+    digest = sha(fname)
+    _update_manifest(fname, digest)
+    return digest
+
+
+def hash_files(fnames, workers=4, full=False):
+    """Return the `cached_sha` of each of `fnames`, hashing up to
+    `workers` files at once."""
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda fname: cached_sha(fname, full), fnames,
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stage_key(*parts):
+    """Return a key that identifies the output of a processing stage.
+
+    The `parts` (typically the stage name, the key or hash of its
+    input, its parameters and the code version) must be JSON
+    serializable; numpy arrays are converted to lists.
+    """
+    txt = json.dumps(parts, sort_keys=True,
+                     default=lambda obj: obj.tolist())
+    return hashlib.sha256(txt.encode('utf-8')).hexdigest()[:16]
+
+
+def stage_current(fname, key):
+    """Is `fname` the output of the stage identified by `key`?"""
+    if not (path.isfile(fname) and path.isfile(fname + '.stage')):
+        return False
+    with open(fname + '.stage') as f:
+        return f.read().strip() == key
+
+
+def stage_record(fname, key):
+    """Record that `fname` was produced by the stage `key`."""
+    with open(fname + '.stage', 'w') as f:
+        f.write(key + '\n')
+
+
 class Finf(object):
 
     def __init__(self, source_fname, url, size, hash=None):
@@ -28,19 +128,19 @@ class Finf(object):
     def __repr__(self, ):
         return '<Finf object: {}>'.format(self.fname)
 
-    def checkhash(self, ):
+    def checkhash(self, full=False):
         if self.hash is None:
             return True
-        return self.hash == sha(self.abs_source_fname)
+        return self.hash == cached_sha(self.abs_source_fname, full)
 
-    def checkfile(self, ):
+    def checkfile(self, full=False):
         if not path.isfile(self.abs_source_fname):
             return None
         if not path.getsize(self.abs_source_fname) == self.size:
             print("Size of local file '{}' is wrong."
                   .format(self.source_fname))
             return False
-        if not self.checkhash():
+        if not self.checkhash(full):
             print("Secure hash of local file '{}' is wrong."
                   .format(self.source_fname))
             return False
@@ -62,17 +162,150 @@ class Finf(object):
         return pkg_root + self.source_fname
 
 
-def retrieve(finf):
+def retrieve(finf, mirror=None, blocksize=2 ** 20, verify_full=False):
+    """Download the source file of `finf`, if it isn't already here.
+
+    The file is downloaded to ``<source_fname>.part`` and hashed as it
+    is written. It is only moved to ``<source_fname>`` once it is
+    complete and its hash is correct. If a ``.part`` file already
+    exists (e.g., after a dropped connection) only the missing bytes
+    are downloaded, and a complete one is just checked and moved.
+
+    Parameters
+    ----------
+    finf : :class:`Finf`
+       The file to retrieve.
+    mirror : string (optional)
+       The base url of a server that has the files (by their local
+       file names) to download from, instead of `finf.url`. See
+       :func:`mirror_server`.
+    blocksize : int
+       The number of bytes to read at a time.
+    verify_full : bool
+       Rehash an existing file, even if the hash manifest says it
+       hasn't changed.
+
+    Returns
+    -------
+    success : bool
+    """
     print("Retrieving file {}...".format(finf.fname))
-    retval = finf.checkfile()
+    retval = finf.checkfile(verify_full)
     if retval:
         print("  File exists, hash check passed.")
-        return
+        return True
     elif retval is None:
         print("  Downloading...")
     elif retval is False:
         print("  hash check failed, redownloading...")
-    response = urlopen(finf.url)
-    with open(finf.abs_source_fname, 'wb') as f:
-        shutil.copyfileobj(response, f)
+    url = finf.url
+    if mirror is not None:
+        url = mirror.rstrip('/') + '/' + path.basename(finf.source_fname)
+    part_fname = finf.abs_source_fname + '.part'
+    h = hashlib.sha256()
+    nbytes = 0
+    if path.isfile(part_fname):
+        with open(part_fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(blocksize), b""):
+                h.update(chunk)
+                nbytes += len(chunk)
+    if nbytes >= finf.size:
+        # E.g., the download finished but wasn't moved into place.
+        print("  The partial download is complete.")
+    else:
+        if nbytes:
+            print("  Resuming at byte {}...".format(nbytes))
+        try:
+            h, nbytes = _download(url, part_fname, h, nbytes, blocksize)
+        except (IOError, OSError) as err:
+            # Network errors (URLError, socket errors, ...). The .part
+            # file is kept, so that the next `pull` resumes it.
+            print("  Download of '{}' failed: {}"
+                  .format(finf.source_fname, err))
+            return False
+    if nbytes != finf.size or \
+       finf.hash is not None and h.hexdigest()[:16] != finf.hash:
+        print("  Download of '{}' failed: wrong size or hash."
+              .format(finf.source_fname))
+        os.remove(part_fname)
+        return False
+    _replace(part_fname, finf.abs_source_fname)
+    _update_manifest(finf.abs_source_fname, h.hexdigest()[:16])
     print("Done.")
+    return True
+
+
+def _download(url, part_fname, h, nbytes, blocksize):
+    # Append `url`, from byte `nbytes`, to `part_fname` (and to the
+    # hash `h`). Returns the hash and the size of `part_fname`.
+    request = Request(url)
+    if nbytes:
+        request.add_header('Range', 'bytes={}-'.format(nbytes))
+    try:
+        response = urlopen(request)
+    except HTTPError as err:
+        if nbytes and err.code == 416:
+            # Range Not Satisfiable: there are no more bytes (`retrieve`
+            # checks the size and hash).
+            return h, nbytes
+        raise
+    if nbytes and response.getcode() != 206:
+        # The server sent the whole file.
+        h = hashlib.sha256()
+        nbytes = 0
+    with open(part_fname, 'ab' if nbytes else 'wb') as f:
+        for chunk in iter(lambda: response.read(blocksize), b""):
+            h.update(chunk)
+            f.write(chunk)
+            nbytes += len(chunk)
+    return h, nbytes
+
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves the files in `root` (by their base names), with support
+    for 'Range: bytes=<start>-' requests."""
+
+    root = '.'
+
+    def translate_path(self, url_path):
+        return path.join(self.root, path.basename(url_path))
+
+    def send_head(self, ):
+        rng = self.headers.get('Range')
+        fname = self.translate_path(self.path)
+        if rng is None or not path.isfile(fname):
+            return SimpleHTTPRequestHandler.send_head(self)
+        size = path.getsize(fname)
+        start = int(rng.split('=')[1].split('-')[0])
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(fname, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range',
+                         'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return f
+
+
+def mirror_server(root, port=8000):
+    """Serve the files in the directory `root` at
+    ``http://localhost:<port>/``, in a background thread.
+
+    This is a stand-in for the data repository (e.g., for testing
+    `retrieve` offline)::
+
+        server = mirror_server('/path/to/ADV/')
+        retrieve(finf, mirror='http://localhost:8000/')
+        server.shutdown()
+    """
+    handler = type('RangeRequestHandler', (_RangeRequestHandler, ),
+                   {'root': root})
+    server = HTTPServer(('localhost', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
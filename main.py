@@ -1,5 +1,9 @@
+from multiprocessing.pool import ThreadPool
 import dolfyn.adv.api as avm
 import filetools as ftbx
+import dattools as dtbx
+import pax
+import pyramid
 
 pkg_root = ftbx.pkg_root
 
@@ -33,7 +37,8 @@ FILEINFO = {
 }
 
 
-def load(tag, coordsys='pax', bin=False):
+def load(tag, coordsys='pax', bin=False, lazy=False,
+         time_range=None, vars=None):
     """Load a data file from this dataset.
 
     Parameters
@@ -55,26 +60,92 @@ def load(tag, coordsys='pax', bin=False):
        Whether to load averaged data (only valid for coordsys 'earth'
        and 'pax')
 
+    lazy : bool (default: False)
+       Return a :class:`dattools.LazyData` view of the file, which
+       only reads variables from the file when they are accessed.
+
+    time_range : 2-element iterable (optional)
+       Only read data within this time range (mpltime values, or date
+       strings, e.g. '2014-06-18 10:00').
+
+    vars : list of strings (optional)
+       Only read these variables (e.g., ['vel'] or ['u']).
+
+    Unbinned 'pax' data is rotated from the earth frame using the
+    principal angle of the whole record (see `pax.cached_angle`).
+
     """
     finf = FILEINFO[tag]
     if bin:
         if coordsys not in ['earth', 'pax']:
             raise Exception("Binned data is only stored in "
                             "the 'earth' and 'pax' coordinate systems.")
-        return avm.load(finf.abs_fname + "_" + coordsys + '_b5m.h5')
+        fname = finf.abs_fname + "_" + coordsys + '_b5m.h5'
+    elif coordsys in ['pax', 'earth']:
+        fname = finf.abs_fname + '_earth.h5'
+    elif coordsys in ['raw']:
+        fname = finf.abs_fname + '.h5'
     else:
-        if coordsys in ['pax', 'earth']:
-            suffix = '_earth'
-        elif coordsys in ['raw']:
-            suffix = ''
-        else:
-            raise Exception('Invalid coordsys specification.')
-        dat = avm.load(finf.abs_fname + suffix + '.h5')
-        if coordsys == 'pax':
-            avm.rotate.earth2principal(dat)
-        return dat
-
-
-def pull(files_info=FILEINFO.values(), test_only=False):
-    for finf in files_info:
-        ftbx.retrieve(finf)
+        raise Exception('Invalid coordsys specification.')
+    rotate = coordsys == 'pax' and not bin
+    if lazy or time_range is not None or vars is not None:
+        rdr = dtbx.H5Reader(fname)
+        indx = slice(None)
+        if time_range is not None:
+            indx = rdr.index(time_range)
+        if lazy and rotate:
+            return pax.PrincipalView(rdr, indx, vars)
+        elif lazy:
+            return dtbx.LazyData(rdr, indx, vars)
+        dat = rdr.block(indx, vars)
+        rdr.close()
+    else:
+        dat = avm.load(fname)
+    if rotate:
+        pax.rotate_principal(dat, pax.cached_angle(fname))
+    return dat
+
+
+def load_pyramid(tag, coordsys='pax'):
+    """Load the min/max pyramid of the velocity of an instrument (see
+    :mod:`pyramid`), for plotting it with `plot_tools.vel_time`.
+
+    The pyramid is built (from the ``_earth.h5`` file) the first time
+    it is loaded.
+    """
+    return pyramid.cached(FILEINFO[tag].abs_fname + '_earth.h5', coordsys)
+
+
+def pull(files_info=FILEINFO.values(), test_only=False,
+         workers=4, mirror=None, verify_full=False):
+    """Download the source data files.
+
+    Parameters
+    ----------
+    files_info : iterable of :class:`filetools.Finf`
+       The files to download (default: all of them).
+    workers : int
+       The number of files to download at once.
+    mirror : string (optional)
+       The url of a server to download the files from instead of the
+       data repository (see `filetools.retrieve`).
+    verify_full : bool
+       Rehash existing files, even if the hash manifest says they
+       haven't changed (see `filetools.cached_sha`).
+
+    Returns
+    -------
+    success : dict
+       Whether each file (by `fname`) was retrieved successfully.
+    """
+    files_info = list(files_info)
+    pool = ThreadPool(workers)
+    try:
+        success = pool.map(
+            lambda finf: ftbx.retrieve(finf, mirror,
+                                       verify_full=verify_full),
+            files_info, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((finf.fname, ok) for finf, ok in zip(files_info, success))
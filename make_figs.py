@@ -1,74 +1,182 @@
+#!/usr/bin/python
+"""
+This script makes the figures of the binned data (in the fig/
+directory)::
+
+    python make_figs.py                       # All figures
+    python make_figs.py ttm01b-top --figs Spec01 --jobs 4
+
+Each instrument's data is loaded once, and the instruments are
+rendered in parallel (with the non-interactive Agg backend). A figure
+is only redrawn when the data file, its parameters (in `figures`) or
+the code that draws it have changed since it was last saved.
+"""
 from __future__ import print_function
-# This script works with dolfyn version 0.3.6
-import plot_tools as pmod
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import numpy as np
-reload(pmod)
 import matplotlib.dates as dt
+import numpy as np
+import os
 from calendar import month_name as month
-import base as j14
+from inspect import getsource
+from multiprocessing import Pool
+from dolfyn.data.time import num2date
+import plot_tools as pmod
+import specavg
+import filetools as ftbx
+from main import FILEINFO, load, pkg_root
+
+fig_dir = pkg_root + 'fig/'
+
+
+def spec01(dat, ftag, uranges, noise_level):
+    fig, axs = pmod.multi_spec_plot(
+        dat, 1100,
+        uranges=np.asarray(uranges),
+        axsize=2,
+        noise_level=noise_level)
+    ax = axs[0, 0]
+    ax.set_xlim([1e-3, 10])
+    ax.set_ylim([1e-5, 1])
+    fig.text(0.5, 0.02, ftag, ha='center', va='bottom')
+    return fig
+
+
+def _time_label(dat):
+    t0 = num2date(dat.mpltime[0])
+    return 'Local Time [Day.Hour {}, {}]'.format(month[t0.month], t0.year)
+
+
+def _time_axis(ax):
+    ax.xaxis.set_major_locator(dt.HourLocator(range(0, 24, 6)))
+    ax.xaxis.set_major_formatter(dt.DateFormatter('%d.%H'))
+    ax.xaxis.set_minor_locator(dt.HourLocator())
+
+
+def time01(dat, ftag, ylims):
+    fig, axs = pmod.vel_time(dat, 1200, )
+    for ax, ylim in zip(axs, ylims):
+        ax.set_ylim(ylim)
+    axs[2].yaxis.set_ticks(np.arange(-1, 1, 0.1))
+    axs[2].set_ylim(ylims[2])
+    _time_axis(axs[2])
+    axs[2].set_xlabel(_time_label(dat))
+    return fig
+
 
-flag = {}
-flag['multi_spec01'] = True
-#flag['time01'] = True
-#flag['time_comb'] = True
+def velcomb01(dat, ftag):
+    fig, ax = pmod.vel_time_comb(dat, 1300, )
+    _time_axis(ax)
+    ax.set_xlabel(_time_label(dat))
+    return fig
 
-if 'data' not in vars():
-    data = {}
-print('')
-for ftag, fn in j14.files.iteritems():
+
+# The figures: {name: (function, parameters)}. Each figure is saved
+# to fig/<tag>_<name>.pdf.
+figures = {
+    'Spec01': (spec01, dict(uranges=np.arange(0, 2.6, 0.5).tolist(),
+                            noise_level=dict(
+                                Spec=[2e-4, 2e-4, 2e-5],
+                                Spec_velraw=[2e-4, 2e-4, 2e-5], ))),
+    'VelTime01': (time01, dict(ylims=[[-2.5, 2.5], [-1.0, 1.0],
+                                      [-0.2, 0.2]])),
+    'VelComb01': (velcomb01, {}),
+}
+
+
+def _fig_key(ftag, name):
+    # The key of a figure: the hash of the data file, the figure's
+    # parameters and the code that draws it (including the helpers in
+    # plot_tools, and the spectral averages of specavg).
+    func, params = figures[name]
+    code = [getsource(func), getsource(_time_label), getsource(_time_axis),
+            getsource(pmod), getsource(specavg)]
+    return ftbx.stage_key('fig', name, ftbx.cached_sha(_data_fname(ftag)),
+                          params, code)
+
+
+def _data_fname(ftag):
+    return FILEINFO[ftag].abs_fname + '_pax_b5m.h5'
+
+
+def _fig_fname(ftag, name):
+    return fig_dir + '{}_{}.pdf'.format(ftag, name)
+
+
+def _render(job):
+    # Load the binned data of one instrument, and draw its figures.
+    ftag, names = job
     print('Creating figures {}...'.format(ftag))
-    if ftag not in data:
-        print('  Loading data...')
-        data[ftag] = j14.load(ftag, bin=True)
-        data[ftag].source_file = fn
-
-    dat = data[ftag]
-
-    if flag.get('multi_spec01', False):
-        print('  Creating Spec01...', end=' ')
-        fig, axs = pmod.multi_spec_plot(
-            dat, 1100,
-            uranges=np.arange(0, 2.6, 0.5),
-            axsize=2,
-            noise_level=dict(Spec=[2e-4, 2e-4, 2e-5],
-                             Spec_velraw=[2e-4, 2e-4, 2e-5],))
-        ax = axs[0, 0]
-        ax.set_xlim([1e-3, 10])
-        ax.set_ylim([1e-5, 1])
-        fig.text(0.5, 0.02, ftag, ha='center', va='bottom')
-        figfile = 'fig/{}_Spec01.pdf'.format(ftag)
-        print('saving ...', end='')
-        fig.savefig(figfile)
-        print('Done.')
-
-    if flag.get('time01', False):
-        print('  Creating Time01...', end=' ')
-        fig, axs = pmod.vel_time(dat, 1200, )
-        axs[0].set_ylim([-2.5, 2.5])
-        axs[1].set_ylim([-1.0, 1.0])
-        axs[2].yaxis.set_ticks(np.arange(-1, 1, 0.1))
-        axs[2].set_ylim([-0.2, 0.2])
-        axs[2].xaxis.set_major_locator(dt.HourLocator(range(0, 24, 6)))
-        axs[2].xaxis.set_major_formatter(dt.DateFormatter('%d.%H'))
-        axs[2].xaxis.set_minor_locator(dt.HourLocator())
-        axs[2].set_xlabel('Local Time [Day.Hour {}, {}]'
-                          .format(month[dat.mpltime.month[0] + 1], dat.mpltime.year[0]))
-        figfile = 'fig/{}_VelTime01.pdf'.format(ftag)
-        print('saving...', end=' ')
-        fig.savefig(figfile)
-        print('Done.')
-
-    if flag.get('time_comb', False):
-        print('  Creating VelComb01...', end=' ')
-        fig, ax = pmod.vel_time_comb(dat, 1300, )
-        ax.xaxis.set_major_locator(dt.HourLocator(range(0, 24, 6)))
-        ax.xaxis.set_major_formatter(dt.DateFormatter('%d.%H'))
-        ax.xaxis.set_minor_locator(dt.HourLocator())
-        ax.set_xlabel('Local Time [Day.Hour {}, {}]'
-                      .format(month[dat.mpltime.month[0] + 1], dat.mpltime.year[0]))
-        figfile = 'fig/{}_VelComb01.pdf'.format(ftag)
-        print('saving...', end=' ')
-        fig.savefig(figfile)
-        print('Done.')
+    dat = load(ftag, bin=True)
+    for name in names:
+        func, params = figures[name]
+        print('  {}: {}...'.format(ftag, name))
+        fig = func(dat, ftag, **params)
+        fig.savefig(_fig_fname(ftag, name))
+        plt.close(fig)
+        ftbx.stage_record(_fig_fname(ftag, name), _fig_key(ftag, name))
+    return ftag, names
+
+
+def build(tags=None, names=None, workers=None, force=False):
+    """Make the figures.
+
+    Parameters
+    ----------
+    tags : list of strings (optional)
+       The instruments (default: all of them).
+    names : list of strings (optional)
+       The figures (default: all of the `figures`).
+    workers : int (optional)
+       The number of processes to use (default: one per instrument).
+    force : bool
+       Redraw the figures even if they are up to date.
+    """
+    if tags is None:
+        tags = sorted(FILEINFO.keys())
+    if names is None:
+        names = sorted(figures.keys())
+    if not os.path.isdir(fig_dir):
+        os.makedirs(fig_dir)
+    jobs = []
+    for ftag in tags:
+        stale = [name for name in names
+                 if force or not ftbx.stage_current(
+                     _fig_fname(ftag, name), _fig_key(ftag, name))]
+        if stale:
+            jobs.append((ftag, stale))
+        else:
+            print('Figures {} are up to date.'.format(ftag))
+    if len(jobs) == 0:
+        return
+    pool = Pool(workers or len(jobs))
+    try:
+        pool.map(_render, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+
+    import argparse
 
+    parser = argparse.ArgumentParser(
+        description="Make the figures of the binned data.")
+    parser.add_argument(
+        'tags', nargs='*',
+        help="The instruments (default: all of them).")
+    parser.add_argument(
+        '--figs', nargs='+', default=None,
+        choices=sorted(figures.keys()),
+        help="The figures to make (default: all of them).")
+    parser.add_argument(
+        '--jobs', type=int, default=None,
+        help="The number of processes to use (default: one per "
+        "instrument).")
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Redraw the figures even if they are up to date.")
+    args = parser.parse_args()
+    build(args.tags or None, args.figs, args.jobs, args.force)
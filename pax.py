@@ -0,0 +1,138 @@
+"""
+Rotations into the 'principal axes' coordinate system.
+
+The principal axes are aligned with the dominant direction of the
+tidal flow. As in DOLfYN's ``calc_principal_angle``, the horizontal
+velocity is 'folded' onto the upper half-plane, the angle of each
+sample is doubled (so that flow near 0 and pi averages correctly),
+and the principal angle is half of the angle of the mean. Because
+that mean is just a sum, the angle can be accumulated one piece of a
+data file at a time, and the rotation applied to each piece
+separately.
+
+The principal angle of each earth-frame file is computed once, and
+stored in ``<fname>.pax.json`` along with the hash of the file.
+"""
+import copy
+import json
+from inspect import getsource
+from os.path import isfile
+import numpy as np
+import filetools as ftbx
+import dattools as dtbx
+
+
+def fold_sum(vel):
+    """The sum of the horizontal velocity `vel[:2]`, as complex
+    numbers folded onto the upper half-plane, with their angles
+    doubled (NaNs are ignored)."""
+    dt = vel[0].astype(np.float64) + 1j * vel[1]
+    dt[dt.imag <= 0] *= -1
+    dt *= np.exp(1j * np.angle(dt))
+    return np.nansum(dt)
+
+
+def sum2angle(total):
+    """The principal angle (radians, counter-clockwise from East, in
+    [0, pi)) of the `fold_sum` `total`."""
+    angle = np.angle(total) / 2
+    if angle < 0:
+        angle += np.pi
+    return angle
+
+
+def principal_angle(vel):
+    """Calculate the principal angle of `vel` (radians,
+    counter-clockwise from East, in [0, pi))."""
+    return sum2angle(fold_sum(vel))
+
+
+def _key(fhash):
+    # The angle depends on the file and on how it is calculated.
+    return ftbx.stage_key('pax', fhash, getsource(fold_sum),
+                          getsource(sum2angle))
+
+
+def cached_angle(fname):
+    """The principal angle of the earth-frame hdf5 file `fname`.
+
+    The angle is only computed if `fname` has changed since it was
+    last computed.
+    """
+    cache_fname = fname + '.pax.json'
+    fhash = ftbx.cached_sha(fname)
+    if isfile(cache_fname):
+        with open(cache_fname) as f:
+            cache = json.load(f)
+        if cache.get('key') == _key(fhash):
+            return cache['principal_angle']
+    rdr = dtbx.H5Reader(fname)
+    angle = float(principal_angle(rdr.read('vel')))
+    rdr.close()
+    with open(cache_fname, 'w') as f:
+        json.dump({'hash': fhash, 'key': _key(fhash),
+                   'principal_angle': angle}, f)
+    return angle
+
+
+def rotate_vec(vec, angle):
+    """Rotate the horizontal components of the vector `vec` (shape
+    ``(3, ...)``) into the principal frame given by `angle`."""
+    cs, sn = np.cos(angle), np.sin(angle)
+    rotmat = np.array([[cs, sn], [-sn, cs]])
+    vec[:2] = np.einsum('ij,j...->i...', rotmat, vec[:2]).astype(vec.dtype)
+    return vec
+
+
+def rotate_orientmat(omat, angle):
+    """Rotate the orientation matrix `omat` (shape ``(3, 3, ...)``,
+    earth to inst) so that it is principal to inst, as DOLfYN's
+    ``earth2principal`` does."""
+    cs, sn = np.cos(angle), np.sin(angle)
+    rotmat = np.array([[cs, sn, 0], [-sn, cs, 0], [0, 0, 1]])
+    omat[:] = np.einsum('ij...,kj->ik...', omat, rotmat).astype(omat.dtype)
+    return omat
+
+
+def rotate_principal(dat, angle):
+    """Rotate the vector variables in `dat` (those in
+    ``props['rotate_vars']``), and the ``orientmat``, from the earth
+    frame into the principal frame given by `angle`.
+    """
+    for nm in dat.props['rotate_vars']:
+        if nm not in dat or dat[nm].ndim != 2:
+            continue
+        rotate_vec(dat[nm], angle)
+    if 'orientmat' in dat:
+        rotate_orientmat(dat['orientmat'], angle)
+    dat.props['principal_angle'] = angle
+    dat.props['coord_sys'] = 'principal'
+    return dat
+
+
+class PrincipalView(dtbx.LazyData):
+    """A :class:`dattools.LazyData` view of an earth-frame file in
+    the principal frame.
+
+    Each vector variable (and the ``orientmat``) is rotated when it
+    is read.
+    """
+
+    def __init__(self, reader, indx=slice(None), names=None):
+        dtbx.LazyData.__init__(self, reader, indx, names)
+        self.angle = cached_angle(reader.fname)
+        self._props = copy.deepcopy(reader.dat.props)
+        self._props['principal_angle'] = self.angle
+        self._props['coord_sys'] = 'principal'
+
+    @property
+    def props(self, ):
+        return self._props
+
+    def _read(self, name):
+        d = dtbx.LazyData._read(self, name)
+        if name in self._props['rotate_vars'] and d.ndim == 2:
+            rotate_vec(d, self.angle)
+        elif name == 'orientmat':
+            rotate_orientmat(d, self.angle)
+        return d
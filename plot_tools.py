@@ -1,6 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.gridspec as gspec
+import dattools as dtbx
+import specavg
+import pyramid
 
 vels = ['u', 'v', 'w']
 
@@ -33,8 +36,23 @@ def calcFigSize(n, ax=np.array([1, 0]),
     return sz, v
 
 
+def _plot_vel(ax, data, comp, time_range=None, **kwargs):
+    # Plot the component `comp` of the velocity in `data` (a data
+    # object, or a :class:`pyramid.Pyramid`).
+    if isinstance(data, pyramid.Pyramid):
+        return data.plot(ax, comp, time_range, **kwargs)
+    return ax.plot(data.mpltime, data.vel[comp], **kwargs)
+
+
 def vel_time(data, fignum=None,
-             frame=[0.8, 0.2, 0.7, 0.5], axsize=[4, 1.7], gap=0.1, ):
+             frame=[0.8, 0.2, 0.7, 0.5], axsize=[4, 1.7], gap=0.1,
+             time_range=None, ):
+    """Plot the velocity components in `data` vs. time.
+
+    `data` may be a :class:`pyramid.Pyramid`, in which case the
+    decimated level that fits the width of the axes and the
+    `time_range` (default: all of it) is plotted.
+    """
     fsr, vr = calcFigSize(3, [axsize[1], gap], frame[2:4])
     fsc, vc = calcFigSize(1, [axsize[0], gap], frame[:2])
 
@@ -46,17 +64,22 @@ def vel_time(data, fignum=None,
     axout = np.empty((3, ), dtype='O')
     for irow in range(3):
         ax = plt.subplot(gs[irow, 0], sharex=ax, sharey=None)
-        ax.plot(data.mpltime, data.vel[irow])
+        _plot_vel(ax, data, irow, time_range)
         if irow < 2:
             plt.setp(ax.get_xticklabels(), visible=False)
         axout[irow] = ax
         ax.axhline(0, linestyle=':', color='k')
         ax.set_ylabel('$%s\,\mathrm{[m/s]}$' % (vels[irow]))
+    if time_range is not None:
+        ax.set_xlim(dtbx.to_mpltime(time_range))
     return fig, axout
 
 
 def vel_time_comb(data, fignum=None,
-                  frame=[0.8, 1.2, 0.7, 0.5], axsize=[4, 2.4], gap=0.1, ):
+                  frame=[0.8, 1.2, 0.7, 0.5], axsize=[4, 2.4], gap=0.1,
+                  time_range=None, ):
+    """Plot the velocity components in `data` vs. time on one axes
+    (see `vel_time`)."""
     fsr, vr = calcFigSize(1, [axsize[1], gap], frame[2:4])
     fsc, vc = calcFigSize(1, [axsize[0], gap], frame[:2])
 
@@ -68,8 +91,10 @@ def vel_time_comb(data, fignum=None,
     ax.axhline(0, linestyle=':', color='k')
     ax.set_ylabel('m/s')
     for irow in range(3):
-        ax.plot(data.mpltime, data.vel[irow], label='$%s$' % (vels[irow]))
+        _plot_vel(ax, data, irow, time_range, label='$%s$' % (vels[irow]))
     ax.legend(loc='upper left', bbox_to_anchor=[1.03, 1])
+    if time_range is not None:
+        ax.set_xlim(dtbx.to_mpltime(time_range))
     return fig, ax
 
 
@@ -82,11 +107,16 @@ def multi_spec_plot(data,
                     axsize=2,
                     frame=[0.8, 1.3, 0.7, .5],
                     gap=[0.1, 0.1],
-                    noise_level={}):
+                    noise_level={},
+                    savg=None):
     """
 
     Parameters
     ----------
+    savg : :class:`specavg.SpecAvg` (optional)
+            The averages of `vars` in the `uranges` (e.g., from
+            `specavg.from_file`). By default these are computed from
+            `data`.
     axsize: axes size (inches)
     frame : 4-element tuple (inches)
             [left, right, bottom, top]
@@ -101,15 +131,13 @@ def multi_spec_plot(data,
     fig.clf()
     gs = gspec.GridSpec(nrow, ncol, hspace=gap[0], wspace=gap[1],
                         left=vc[0], right=vc[1], bottom=vr[0], top=vr[1], )
+    if savg is None:
+        savg = specavg.SpecAvg(data, list(zip(uranges[:-1], uranges[1:])),
+                               names=vars, u_abs=u_abs)
     ax = None
     axout = np.empty((nrow, ncol), dtype='O')
     for icol in range(ncol):
-        if u_abs:
-            udat = np.abs(data.u)
-        else:
-            udat = data.u
-        inds = ((uranges[icol] < udat) &
-                (udat <= uranges[icol + 1]))
+        count = savg.count[icol]
         for irow in range(nrow):
             ax = plt.subplot(gs[irow, icol], sharex=ax, sharey=ax)
             for v in vars:
@@ -130,9 +158,9 @@ def multi_spec_plot(data,
                     noise = noise_level[v]
                     if hasattr(noise, '__iter__'):
                         noise = noise[irow]
-                if inds.sum() > 0:
-                    ax.loglog(data.freq,
-                              data[v][irow][inds].mean(0) * 2 * np.pi - noise,
+                if count > 0:
+                    ax.loglog(savg.freq,
+                              savg.mean[v][irow, icol] * 2 * np.pi - noise,
                               label=label, color=color)
             if icol != 0 or irow != (nrow - 1):
                 plt.setp(ax.get_yticklabels(), visible=False)
@@ -144,7 +172,7 @@ def multi_spec_plot(data,
             title_format = '${:.1f}<u\leq{:.1f}$'
         ax = axout[0, icol]
         ax.set_title(title_format.format(*(uranges[icol:icol + 2])))
-        ax.text(0.94, 0.94, 'N={:d}'.format(inds.sum()),
+        ax.text(0.94, 0.94, 'N={:d}'.format(count),
                 ha='right', va='top',
                 transform=ax.transAxes)
     for irow in range(nrow):
@@ -4,10 +4,21 @@ This script is for processing the ADV data files in the ADV/ directory.
 """
 import dolfyn.adv.api as avm
 from dolfyn.tools import within
-from dolfyn.data.time import num2date
 import numpy as np
+import json
+import os
+import sys
+import threading
+import traceback
+from multiprocessing import Pool
+from inspect import getsource
 from os.path import isfile
 from main import FILEINFO
+import filetools as ftbx
+import dattools as dtbx
+import pax
+import spectra
+import timing
 
 # # The file names:
 # FNAMES = {ky: val.basename for ky, val in FILEINFO.iteritems()}
@@ -21,10 +32,66 @@ spec_noise = [1.5e-4,
               1.5e-5, ]
 pii = 2 * np.pi
 
-mc = avm.motion.CorrectMotion()
+# The valid range of each velocity component [m/s]; data outside
+# these limits is replaced using a polynomial fit (`fillpoly_args` is
+# (degree, npoints)).
+clean_limits = [[-2.5, 0.5],
+                [-1, 1],
+                [-1, 1], ]
+fillpoly_args = (3, 12)
+
+# The number of ensembles to read from a .vec file at a time (~4.5
+# hours at 16 Hz).
+read_chunk = 2 ** 18
+
+# The number of 5-minute bins to read at a time in `average_h5`.
+bins_per_block = 12
+
+# In incremental mode (see `_process_incremental`), the data before
+# (and after) the new bins that is included in the cleaning and
+# motion correction [seconds]. This is longer than the fill/despike
+# windows and the motion correction filters need to settle, and at
+# least one bin, so that the cross-spectra of the new bins include the
+# data of the bins next to them (as they do in `_process`).
+incr_overlap = 10 * 60
 
+mc = avm.motion.CorrectMotion()
 
-def run(finfo=FILEINFO.values(), readvec=None, savecsv=False):
+# The outputs of each stage of `_process`.
+_outputs = {'raw': '.h5',
+            'earth': '_earth.h5',
+            'mat': '_earth.mat',
+            'earth_b5m': '_earth_b5m.h5',
+            'csv': '_Average5min.csv',
+            'pax_b5m': '_pax_b5m.h5', }
+
+# The units and descriptions of the variables in the .h5 and _earth.h5
+# files (keyword arguments of ``dat.save``).
+_save_meta = {
+    'units': {
+        'vel': 'm/s', 'velrot': 'm/s',
+        'velacc': 'm/s', 'AngRt': 'rad/s',
+        'Accel': 'm/s^2', 'AccelStable': 'm/s^2',
+        'pitch': 'deg', 'roll': 'deg', 'heading': 'deg true',
+        'mpltime': 'MatPlotLib Time format',
+        'time': 'ISO8601 time strings.', },
+    'description': {
+        'vel': 'Velocity array 0:True East, 1: True North, 2: Up',
+        'velrot': 'The rotation-rate velocity.',
+        'velacc': 'The tranlational (acceleration) velocity.',
+        'AccelStable': 'The low-frequency acceleration that is ignored '
+        'in calculating velacc.',
+        'pitch': 'The pitch of the ADV body',
+        'roll': 'The roll of the ADV body',
+        'heading': 'The heading (True) of the ADV body',
+        'orientmat': "The orientation matrix of the ADV body in the "
+        "Earth's reference frame", },
+}
+
+
+def run(finfo=FILEINFO.values(), readvec=None, savecsv=False,
+        workers=None, force=False, outofcore=False, storage=None,
+        mat73=False, report=None, profile=None, incremental=False):
     """
     Process the ADV data.
 
@@ -35,41 +102,385 @@ def run(finfo=FILEINFO.values(), readvec=None, savecsv=False):
          them).
     readvec : {True, None, False}
          Whether to read the raw ``.vec`` file, or load the ``.h5``
-         file. Default: read .h5, if it is available.
+         file. Default: read .h5, if it is up to date.
     savecsv : bool
          Save the ``_average5min.csv`` files?
+    workers : int or None
+         The number of processes to spread the files over. If this is
+         None (default) the files are processed one after another in
+         this process. Otherwise each file's output is written to
+         ``<basename>.process.log`` instead of the terminal.
+    force : bool
+         Recompute every stage, even if its output is up to date.
+    outofcore : bool
+         Average the data one block of bins at a time, from the
+         ``_earth.h5`` file (see `average_h5`), instead of in memory.
+    storage : string (optional)
+         The hdf5 storage profile of the output files (one of
+         `dattools.storage_profiles`; default:
+         `dattools.storage_profile`).
+    mat73 : bool
+         Save the ``_earth.mat`` files in MATLAB's v7.3 (hdf5-based)
+         format (see `dattools.save_mat73`).
+    report : string or False
+         The JSON file to write the timing and resource use of each
+         stage to (see `timing.save_report`; default: a new file in
+         `timing.report_dir`). False: don't write a report.
+    profile : string (optional)
+         Save a cProfile of each stage (of each file) to this
+         directory.
+    incremental : bool
+         Only process the data that has been added to the .vec files
+         since the last incremental run, and append it to the
+         ``_earth.h5`` and ``_earth_b5m.h5`` files (see
+         `_process_incremental`). This is for files that grow during
+         a deployment.
+
+    Notes
+    -----
+    Each stage's output is only recomputed when its key (see
+    `_stage_keys`) differs from the one recorded in the
+    ``<output>.stage`` file next to it.
+
+    Returns
+    -------
+    summary : list of (fname, success, message) tuples
+         `message` is the traceback of the error for files that failed.
     """
-    for finf in finfo:
-        print("File: {}".format(finf.fname))
-        if readvec is True or \
-           readvec is None and not isfile(finf.abs_fname + '.h5'):
-            dr = _read_raw(finf)
+    timing.profile_dir = profile
+    nrec = len(timing.records)
+    jobs = [(finf, readvec, savecsv, force, outofcore, mat73, incremental,
+             storage or dtbx.storage_profile, workers is not None)
+            for finf in finfo]
+    if workers is None:
+        summary = [_run_one(job)[:3] for job in jobs]
+    else:
+        pool = Pool(workers)
+        try:
+            out = pool.map(_run_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        summary = []
+        for fname, ok, msg, recs in out:
+            summary.append((fname, ok, msg))
+            timing.records.extend(recs)
+    nfail = sum(not ok for fname, ok, msg in summary)
+    print("Processed {} files, {} failed."
+          .format(len(summary), nfail))
+    for fname, ok, msg in summary:
+        print("  {}: {}".format(fname, 'OK' if ok else 'FAILED'))
+    if report is not False:
+        report = timing.save_report(
+            report, 'process_adv',
+            info={'files': [fname for fname, ok, msg in summary],
+                  'readvec': readvec, 'force': force,
+                  'outofcore': outofcore, 'workers': workers,
+                  'storage': storage or dtbx.storage_profile,
+                  'mat73': mat73, 'incremental': incremental},
+            recs=timing.records[nrec:])
+        print("Timing report: {}".format(report))
+    return summary
+
+
+def _run_one(job):
+    (finf, readvec, savecsv, force, outofcore, mat73, incremental,
+     storage, logfile) = job
+    dtbx.storage_profile = storage
+    timing.current_file = finf.fname
+    nrec = len(timing.records)
+    stdout = sys.stdout
+    if logfile:
+        sys.stdout = open(finf.abs_fname + '.process.log', 'w')
+    try:
+        if incremental:
+            _process_incremental(finf)
         else:
-            dr = avm.load(finf.abs_fname + '.h5')
-
-        drm = correct_motion(dr, finf)
-
-        print('  Saving matlab file...')
-        drm.add_data('datenum', drm.mpltime + 366, 'main')
-        drm.save_mat(finf.abs_fname + '_earth.mat', groups=['orient', 'main'])
-        drm.pop_data('datenum')
-
-        bdat = average(drm)
-
+            _process(finf, readvec, savecsv, force, outofcore, mat73)
+    except Exception:
+        msg = traceback.format_exc()
+        print(msg)
+        return finf.fname, False, msg, timing.records[nrec:]
+    finally:
+        if logfile:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return finf.fname, True, '', timing.records[nrec:]
+
+
+def _stage_keys(finf, readvec, mat73=False):
+    """Compute the key of each stage's output.
+
+    The first stage is keyed on the hash of the source file; every
+    later stage is keyed on the key of its input, so that a key
+    changes whenever anything upstream of it changes. The source code
+    of the functions that do the work is part of each key.
+    """
+    def key(stage, parent, code=(), **params):
+        return ftbx.stage_key(stage, parent, params,
+                              [getsource(func) for func in code])
+
+    keys = {}
+    if readvec is False or (not isfile(finf.abs_source_fname) and
+                            isfile(finf.abs_fname + '.h5')):
+        keys['raw'] = ftbx.cached_sha(finf.abs_fname + '.h5')
+    else:
+        keys['raw'] = key('raw', ftbx.cached_sha(finf.abs_source_fname),
+                          code=[_read_raw, _read_vec, _clean_raw,
+                                clean_vel],
+                          clean_limits=clean_limits,
+                          fillpoly_args=fillpoly_args)
+    keys['earth'] = key('earth', keys['raw'],
+                        code=[correct_motion, _motion])
+    keys['mat'] = key('mat', keys['earth'], code=[save_mat], mat73=mat73)
+    keys['earth_b5m'] = key('average', keys['earth'],
+                            code=[average, _calc_spectra,
+                                  _calc_spectra_fused,
+                                  spectra.FusedSpectra, calc_tripprod,
+                                  calc_epsilon],
+                            eps_freqs=eps_freqs,
+                            spec_noise=spec_noise)
+    keys['csv'] = key('csv', keys['earth_b5m'], code=[_save_csv])
+    keys['pax_b5m'] = key('pax', keys['earth_b5m'],
+                          code=[pax.fold_sum, pax.sum2angle, pax.rotate_vec,
+                                pax.rotate_orientmat, pax.rotate_principal])
+    return keys
+
+
+def _process(finf, readvec, savecsv, force=False, outofcore=False,
+             mat73=False):
+    print("File: {}".format(finf.fname))
+    keys = _stage_keys(finf, readvec, mat73)
+    fnames = dict((nm, finf.abs_fname + sfx)
+                  for nm, sfx in _outputs.items())
+    stale = dict((nm, force or
+                  not ftbx.stage_current(fnames[nm], keys[nm]))
+                 for nm in keys)
+    # Without the source file, an existing .h5 file is used as-is.
+    stale['raw'] = readvec is True or (
+        readvec is None and stale['raw'] and
+        (isfile(finf.abs_source_fname) or not isfile(fnames['raw'])))
+    if not savecsv:
+        stale['csv'] = False
+
+    dr = drm = bdat = None
+    if stale['raw']:
+        dr = _read_raw(finf)
+        ftbx.stage_record(fnames['raw'], keys['raw'])
+
+    if stale['earth']:
+        if dr is None:
+            with timing.stage('load'):
+                dr = avm.load(fnames['raw'])
+        drm = correct_motion(dr, finf, inplace=True)
+        ftbx.stage_record(fnames['earth'], keys['earth'])
+    dr = None
+
+    if drm is None and (stale['mat'] or not outofcore and
+                        (stale['earth_b5m'] or stale['pax_b5m'])):
+        with timing.stage('load'):
+            drm = avm.load(fnames['earth'])
+
+    # The matlab file is written in the background, while the data
+    # is averaged (which only reads `drm`).
+    mat_writer = None
+    if stale['mat']:
+        print('  Saving matlab file (in the background)...')
+        mat_writer = _Background(save_mat, drm, fnames['mat'], mat73)
+    if outofcore:
+        drm = None
+
+    if stale['earth_b5m']:
+        with timing.stage('average'):
+            if outofcore:
+                bdat = average_h5(fnames['earth'])
+            else:
+                bdat = average(drm)
         print("  Saving binned data to hdf5...")
-        bdat.save(finf.abs_fname + '_earth_b5m.h5')
-
-        if savecsv:
+        with timing.stage('save'):
+            dtbx.save(bdat, fnames['earth_b5m'], bins_per_block)
+        ftbx.stage_record(fnames['earth_b5m'], keys['earth_b5m'])
+
+    if stale['csv']:
+        if bdat is None:
+            bdat = avm.load(fnames['earth_b5m'])
+        with timing.stage('csv'):
             _save_csv(bdat, finf)
-
+        ftbx.stage_record(fnames['csv'], keys['csv'])
+
+    if mat_writer is not None:
+        # The rotation to the principal frame changes `drm`.
+        with timing.stage('mat_wait'):
+            mat_writer.join()
+        ftbx.stage_record(fnames['mat'], keys['mat'])
+
+    if stale['pax_b5m'] and outofcore:
+        print("  Binning in the Principal frame...")
+        with timing.stage('average_pax'):
+            bdat2 = average_h5(fnames['earth'], principal=True)
+    elif stale['pax_b5m']:
         print("  Rotating to Principal frame...")
-        avm.rotate.earth2principal(drm)
+        with timing.stage('rotate'):
+            pax.rotate_principal(drm, pax.cached_angle(fnames['earth']))
         print("  Binning and saving...")
-        bdat2 = average(drm)
-
-        bdat2.save(finf.abs_fname + '_pax_b5m.h5')
-
-        print("Done.")
+        with timing.stage('average_pax'):
+            bdat2 = average(drm)
+    if stale['pax_b5m']:
+        with timing.stage('save'):
+            dtbx.save(bdat2, fnames['pax_b5m'], bins_per_block)
+        ftbx.stage_record(fnames['pax_b5m'], keys['pax_b5m'])
+
+    print("Done.")
+
+
+def _incr_config():
+    # The parameters that the incremental outputs depend on.
+    return {'clean_limits': np.asarray(clean_limits).tolist(),
+            'fillpoly_args': list(fillpoly_args),
+            'overlap': incr_overlap,
+            'read_chunk': read_chunk,
+            'eps_freqs': np.asarray(eps_freqs).tolist(),
+            'spec_noise': list(spec_noise), }
+
+
+def _process_incremental(finf):
+    """Process the data that has been appended to the .vec file of
+    `finf` since the last time this ran.
+
+    The ``_earth.h5`` and ``_earth_b5m.h5`` files are extended with
+    every new complete 5-minute bin. The number of bins that are done
+    is stored in the checkpoint file ``<basename>.checkpoint.json``.
+    The cleaning and motion correction of the new data include
+    `incr_overlap` seconds of the data before it, and only bins that
+    end at least `incr_overlap` seconds before the end of the data
+    (or the end of ``time_range``) are completed.
+
+    The other outputs (``.h5``, ``.mat``, ``.csv``, ``_pax_b5m.h5``)
+    are not made in this mode; run `_process` when the deployment is
+    over.
+    """
+    print("File: {} (incremental)".format(finf.fname))
+    fnames = dict((nm, finf.abs_fname + _outputs[nm])
+                  for nm in ['earth', 'earth_b5m'])
+    ck_fname = finf.abs_fname + '.checkpoint.json'
+    ck = None
+    if isfile(ck_fname):
+        with open(ck_fname) as f:
+            ck = json.load(f)
+    if ck is None or ck['config'] != _incr_config():
+        print("  Starting from the beginning of the file...")
+        for fname in fnames.values():
+            if isfile(fname):
+                os.remove(fname)
+        ck = {'config': _incr_config(), 'ens0': None, 'n_bin': None,
+              'n_done': 0, }
+    else:
+        # Remove any data that was written after the checkpoint
+        # (e.g., by a run that was interrupted).
+        dtbx.truncate(fnames['earth'], ck['n_done'])
+        dtbx.truncate(fnames['earth_b5m'], ck['n_done'] // ck['n_bin'])
+
+    while True:
+        # The index (from the start of the record) of the first data
+        # point to read.
+        i0 = 0
+        if ck['ens0'] is not None:
+            n_overlap = int(incr_overlap * ck['fs'])
+            i0 = max(ck['n_done'] - n_overlap, 0)
+        ens = i0 + (ck['ens0'] or 0)
+        try:
+            with timing.stage('read'):
+                dr = _read_vec(finf.abs_source_fname, start=ens,
+                               nmax=read_chunk)
+        except NoDataError:
+            break
+        eof = dtbx.ntime(dr) < read_chunk
+        if ck['ens0'] is None:
+            ck['ens0'] = dr.props['ens_range'][0]
+            ck['fs'] = float(dr.fs)
+            ck['n_bin'] = int(5 * 60 * dr.fs)
+        n_bin = ck['n_bin']
+        n_end = i0 + dtbx.ntime(dr)
+        at_end = (dr.mpltime[-1] + 1. / dr.fs / 86400 >=
+                  dr.props['time_range'][1])
+        if not at_end:
+            n_end -= int(incr_overlap * dr.fs)
+        n_commit = n_end // n_bin * n_bin
+        if n_commit <= ck['n_done']:
+            break
+        print("  {} new bins...".format((n_commit - ck['n_done']) // n_bin))
+        with timing.stage('clean'):
+            _clean_raw(dr)
+        with timing.stage('motion'):
+            _motion(dr)
+        j0, j1 = ck['n_done'] - i0, n_commit - i0
+        with timing.stage('save'):
+            dtbx.append(dtbx.time_slice(dr, slice(j0, j1)),
+                        fnames['earth'], n_bin, **_save_meta)
+        # The cross-spectra of a bin use the data of the bins next to
+        # it, so the new bins are averaged along with their neighbours
+        # (if they are in `dr`), which are then dropped.
+        k0 = j0 - n_bin if j0 >= n_bin else j0
+        k1 = min(j1 + n_bin, dtbx.ntime(dr))
+        with timing.stage('average'):
+            bdat = average(dtbx.time_slice(dr, slice(k0, k1)))
+            bdat = dtbx.time_slice(bdat, slice((j0 - k0) // n_bin,
+                                               (j1 - k0) // n_bin))
+        with timing.stage('save'):
+            dtbx.append(bdat, fnames['earth_b5m'], bins_per_block)
+        ck['n_done'] = n_commit
+        ck['time_done'] = float(dr.mpltime[j1 - 1])
+        tmp = ck_fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(ck, f, indent=1)
+        os.rename(tmp, ck_fname)
+        dr = bdat = None
+        if at_end or eof:
+            break
+    print("  {} bins done.".format(ck['n_done'] // (ck['n_bin'] or 1)))
+
+
+class _Background(threading.Thread):
+    # Run ``func(*args)`` in a thread. `join` re-raises any error
+    # from `func` (with its traceback in the message).
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.func = func
+        self.args = args
+        self.error = None
+        self.start()
+
+    def run(self, ):
+        try:
+            self.func(*self.args)
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error is not None:
+            raise RuntimeError("Background task failed:\n" + self.error)
+
+
+def save_mat(drm, fname, mat73=False):
+    """Save the 'orient' and 'main' groups of `drm` to the matlab
+    file `fname`, with a ``datenum`` (MATLAB time) variable.
+
+    `drm` is not changed: ``datenum`` is added to a shallow copy of
+    it, or, for v7.3 files (`mat73`), it is computed one chunk at a
+    time as the file is written (see `dattools.save_mat73`).
+    """
+    groups = ['orient', 'main']
+    with timing.stage('mat'):
+        if mat73:
+            dtbx.save_mat73(
+                drm, fname, groups,
+                extra={'datenum': lambda indx: drm.mpltime[indx] + 366})
+            return
+        out = dtbx.cow_copy(drm, ())
+        out.add_data('datenum', out.mpltime + 366, 'main')
+        out.save_mat(fname, groups=groups)
 
 
 def _read_raw(finf):
@@ -78,54 +489,115 @@ def _read_raw(finf):
         print("File not found.")
         if finf in FILEINFO.values():
             print("... Try running the main.pull function?")
-    dr = avm.read_nortek(finf.abs_source_fname)
+    with timing.stage('read'):
+        dr = _read_vec(finf.abs_source_fname)
+
+    ##########
+    print('  Cleaning the data...')
+    with timing.stage('clean'):
+        _clean_raw(dr)
+    print('  Saving...')
+    with timing.stage('save'):
+        dtbx.save(dr, finf.abs_fname + '.h5', int(5 * 60 * dr.fs),
+                  **_save_meta)
+    return dr
+
 
+def _clean_raw(dr):
+    # Clean the data read by `_read_vec` (in place). The data is
+    # already float32.
     dr.noise[0] = 0
     dr.noise[1] = 0
     dr.noise[2] = 0
-
-    # Crop the data when the instrument was on the seafloor
-    dr = dr.subset(within(dr.mpltime, dr.props['time_range']))
-
-    ##########
-    print('  Cleaning the data...')
-    dr.u[~within(dr.u, [-2.5, 0.5])] = np.NaN
-    avm.clean.fillpoly(dr.u, 3, 12)
-    dr.v[~within(dr.v, [-1, 1])] = np.NaN
-    avm.clean.fillpoly(dr.v, 3, 12)
-    dr.v[~within(dr.w, [-1, 1])] = np.NaN
-    avm.clean.fillpoly(dr.w, 3, 12)
-    avm.clean.GN2002(dr.u)
-    avm.clean.GN2002(dr.v)
-    avm.clean.GN2002(dr.w)
-    for nm, d in dr.iter():
-        if isinstance(d, np.ndarray) and \
-           d.dtype == np.float64 and nm not in ['mpltime']:
-            dr[nm] = d.astype(np.float32)
+    clean_vel(dr.vel)
     if dr.has_imu:
         (dr.pitch,
          dr.roll,
          dr.heading) = avm.rotate.orient2euler(dr.orientmat)
-    print('  Saving...')
-    dr.save(finf.abs_fname + '.h5',
-            units={
-                'vel': 'm/s', 'velrot': 'm/s',
-                'velacc': 'm/s', 'AngRt': 'rad/s',
-                'Accel': 'm/s^2', 'AccelStable': 'm/s^2',
-                'pitch': 'deg', 'roll': 'deg', 'heading': 'deg true',
-                'mpltime': 'MatPlotLib Time format',
-                'time': 'ISO8601 time strings.', },
-            description={
-                'vel': 'Velocity array 0:True East, 1: True North, 2: Up',
-                'velrot': 'The rotation-rate velocity.',
-                'velacc': 'The tranlational (acceleration) velocity.',
-                'AccelStable': 'The low-frequency acceleration '
-                'that is ignored in calculating velacc.',
-                'pitch': 'The pitch of the ADV body',
-                'roll': 'The roll of the ADV body',
-                'heading': 'The heading (True) of the ADV body',
-                'orientmat': "The orientation matrix of the"
-                " ADV body in the Earth's reference frame", })
+
+
+def clean_vel(vel, limits=None):
+    """Clean the velocity `vel` (shape ``(3, N)``) in place.
+
+    Data outside the `limits` of each component (default:
+    `clean_limits`) is replaced using a polynomial fit (see
+    `fillpoly_args`), and then the Goring & Nikora (2002) despiking
+    algorithm is applied to each component.
+    """
+    if limits is None:
+        limits = clean_limits
+    limits = np.asarray(limits, dtype=vel.dtype)
+    bad = ~((limits[:, :1] < vel) & (vel < limits[:, 1:]))
+    vel[bad] = np.NaN
+    for comp, isbad in zip(vel, bad.any(-1)):
+        if isbad:
+            avm.clean.fillpoly(comp, *fillpoly_args)
+    for comp in vel:
+        avm.clean.GN2002(comp)
+    return vel
+
+
+class NoDataError(Exception):
+    # There is no data in (the requested part of) a file.
+    pass
+
+
+def _read_vec(fname, chunk_size=read_chunk, start=0, nmax=None):
+    """Read the Nortek Vector file `fname`, `chunk_size` ensembles at
+    a time.
+
+    Only the data within ``props['time_range']`` (when the
+    instrument was on the seafloor) is kept, and it is stored as
+    float32 as it is read. This way the full-length float64 arrays
+    that ``read_nortek`` creates only ever exist for one chunk.
+
+    Reading starts at ensemble `start`, and stops after `nmax` data
+    points have been kept (default: read to the end). The range of
+    ensembles that were kept is stored in ``props['ens_range']``.
+    """
+    i0 = start
+    dr = None
+    nout = 0
+    ens0 = None
+    while True:
+        nchunk = chunk_size
+        if nmax is not None and nout > 0:
+            nchunk = min(chunk_size, nmax - nout)
+        dat = avm.read_nortek(fname, nens=(i0, i0 + nchunk))
+        nread = dtbx.ntime(dat)
+        if nread == 0:
+            break
+        trange = dat.props['time_range']
+        done = nread < nchunk or dat.mpltime[-1] >= trange[1]
+        # Crop the data when the instrument was on the seafloor
+        inds = within(dat.mpltime, trange)
+        dat = dat.subset(inds)
+        n = dtbx.ntime(dat)
+        if nmax is not None and nout + n >= nmax:
+            n = nmax - nout
+            done = True
+        if n > 0:
+            if ens0 is None:
+                ens0 = i0 + np.nonzero(inds)[0][0]
+            chunk = dict(dtbx.iter_tseries(dat))
+            if dr is None:
+                nalloc = int((trange[1] - trange[0]) * 24 * 3600 *
+                             dat.fs) + 1
+                if nmax is not None:
+                    nalloc = min(nalloc, nmax)
+                dr = dtbx.preallocate(dat, nalloc)
+            for nm, d in chunk.items():
+                dr[nm][..., nout:nout + n] = d[..., :n]
+            nout += n
+        i0 += nread
+        if done:
+            break
+    if dr is None:
+        raise NoDataError("No data within the time_range of '{}'."
+                          .format(fname))
+    for nm, d in list(dtbx.iter_tseries(dr)):
+        dr[nm] = d[..., :nout]
+    dr.props['ens_range'] = [int(ens0), int(ens0 + nout)]
     return dr
 
 
@@ -135,56 +607,187 @@ def _save_csv(bdat, finf):
         ti[bdat.U_mag < 0.7] = np.NaN
 
         print("  Saving average csv file...")
-        np.savetxt(finf.abs_fname + '_Average5min.csv',
-                   np.vstack((num2date(bdat.mpltime), bdat.u,
-                              bdat.v, bdat.w, ti)).T,
-                   fmt=['%s'] + ['%0.3f'] * 4,
-                   header='Date+Time (US/Pacific), u (true east m/s), '
-                          'v (true north m/s), w (up m/s), '
-                          'Turbulence Intensity',
-                   delimiter=', ')
+        dtbx.save_csv(finf.abs_fname + '_Average5min.csv',
+                      dtbx.array_blocks(bdat.mpltime,
+                                        [bdat.u, bdat.v, bdat.w, ti]),
+                      ['u', 'v', 'w', 'ti'], time_unit='s',
+                      header='Date+Time (US/Pacific), u (true east m/s), '
+                             'v (true north m/s), w (up m/s), '
+                             'Turbulence Intensity')
+
 
+def export_table(fname, out_fname, names=('u', 'v', 'w'),
+                 time_range=None, n_block=2 ** 16):
+    """Export variables of the processed hdf5 file `fname` (e.g., the
+    16 Hz ``_earth.h5`` file, or a ``_b5m.h5`` file) to a csv or
+    Parquet file.
 
-def correct_motion(dr, finf):
+    Parameters
+    ----------
+    fname : string
+         The hdf5 file.
+    out_fname : string
+         The output file. Its extension ('.csv' or '.parquet') sets
+         its format. Parquet files require the pyarrow package.
+    names : list of strings
+         The (1-D) variables to export.
+    time_range : 2-element iterable (optional)
+         The time range (mpltime values or date strings) to export
+         (default: all of it).
+    n_block : int
+         The number of rows that are read and written at a time.
+    """
+    rdr = dtbx.H5Reader(fname)
+    try:
+        indx = slice(None)
+        if time_range is not None:
+            indx = rdr.index(time_range)
+        blocks = dtbx.reader_blocks(rdr, names, n_block, indx)
+        if out_fname.endswith('.parquet'):
+            dtbx.save_parquet(out_fname, blocks, names)
+        else:
+            dtbx.save_csv(out_fname, blocks, names)
+    finally:
+        rdr.close()
+
+
+def correct_motion(dr, finf, inplace=False):
+    """Motion correct `dr` and save it to ``<basename>_earth.h5``.
+
+    If `inplace` is False, `dr` is left unchanged; only the
+    variables that motion correction changes are copied.
+    """
 
     print('  Motion correcting...')
-    drm = dr.copy()
+    with timing.stage('motion'):
+        if inplace:
+            drm = dr
+        else:
+            drm = dtbx.cow_copy(dr, _motion_vars(dr))
+        _motion(drm)
+    print('  Saving...')
+    with timing.stage('save'):
+        dtbx.save(drm, finf.abs_fname + '_earth.h5', int(5 * 60 * drm.fs),
+                  **_save_meta)
+    return drm
+
+
+def _motion(drm):
+    # Motion correct `drm` in place.
     mc(drm)
     (drm.pitch[:],
      drm.roll[:],
      drm.heading[:]) = avm.rotate.orient2euler(drm.orientmat)
-    print('  Saving...')
-    drm.save(finf.abs_fname + '_earth.h5',
-             units={
-                 'vel': 'm/s', 'velrot': 'm/s',
-                 'velacc': 'm/s', 'AngRt': 'rad/s',
-                 'Accel': 'm/s^2', 'AccelStable': 'm/s^2',
-                 'pitch': 'deg', 'roll': 'deg', 'heading': 'deg true',
-                 'mpltime': 'MatPlotLib Time format',
-                 'time': 'ISO8601 time strings.', },
-             description={
-                 'vel': 'Velocity array 0:True East, 1: True North, 2: Up',
-                 'velrot': 'The rotation-rate velocity.',
-                 'velacc': 'The tranlational (acceleration) velocity.',
-                 'AccelStable': 'The low-frequency acceleration that'
-                 ' is ignored in calculating velacc.',
-                 'pitch': 'The pitch of the ADV body',
-                 'roll': 'The roll of the ADV body',
-                 'heading': 'The heading (True) of the ADV body',
-                 'orientmat': "The orientation matrix of the ADV "
-                 "body in the Earth's reference frame", })
-    return drm
 
 
-def average(dat):
+def _motion_vars(dat):
+    # The variables that motion correction changes in place.
+    return set(dat.props['rotate_vars']) | {'vel', 'pitch', 'roll',
+                                            'heading'}
+
+
+def average(dat, fused=False):
+    """Average `dat` into 5-minute bins.
+
+    Parameters
+    ----------
+    dat : ADV data object
+       The (motion-corrected) data to average.
+    fused : bool
+       Compute the spectra and cross-spectra from one FFT of each
+       velocity signal (see `spectra.FusedSpectra`), rather than with
+       separate ``TurbBinner.calc_vel_psd``/``calc_vel_cpsd`` calls.
+    """
     print("  Averaging...")
-    bnr = avm.TurbBinner(n_bin=5 * 60 * dat.fs, fs=dat.fs)
+    bnr = avm.TurbBinner(n_bin=int(5 * 60 * dat.fs), fs=dat.fs)
+
+    bdat = bnr(dat)
+
+    bdat.props['Cspec_comp'] = ['uv', 'uw', 'vw']
+    if fused:
+        _calc_spectra_fused(bnr, dat, bdat)
+    else:
+        _calc_spectra(bnr, dat, bdat)
+
+    # Calculate triple products ####
+    bdat.props['tripprod_comp'] = [['uuu', 'uuv', 'uuw', ],
+                                   ['vvu', 'vvv', 'vvw', ],
+                                   ['wwu', 'wwv', 'www', ]]
+    bdat.add_data('tripprod', calc_tripprod(dat.vel, bnr.n_bin), 'turb')
+
+    # Calculate the dissipation rate ####
+    bdat.add_data('epsilon', calc_epsilon(bnr, bdat), 'main')
+    return bdat
+
+
+def calc_tripprod(vel, n_bin, dtype=np.float32):
+    """Calculate the triple products ``<u_i u_i u_j>`` of `vel`.
+
+    Parameters
+    ----------
+    vel : array (3, N)
+       The velocity.
+    n_bin : int
+       The number of points in each bin (e.g., a TurbBinner's
+       ``n_bin``, which may be a float).
+    dtype : numpy dtype
+       The precision of the calculation (default: float32).
+
+    Returns
+    -------
+    tripprod : array (3, 3, n_bins)
+       ``tripprod[i, j]`` is the bin-average of ``u_i ** 2 * u_j``.
+    """
+    n_bin = int(n_bin)
+    nb = vel.shape[-1] // n_bin
+    turb = vel[:, :nb * n_bin].reshape(3, nb, n_bin).astype(dtype)
+    turb -= turb.mean(-1)[..., None]
+    # A batched (over bins) matrix product of the squared components
+    # with the components: (nb, 3, n_bin) x (nb, n_bin, 3)
+    tripprod = np.matmul((turb ** 2).transpose(1, 0, 2),
+                         turb.transpose(1, 2, 0))
+    return (tripprod / n_bin).transpose(1, 2, 0).astype(np.float32)
+
+
+def calc_epsilon(bnr, bdat, freqs=None, noise=None):
+    """Calculate the dissipation rate from the spectra in `bdat`.
+
+    The dissipation rate is estimated for each velocity component from
+    the (noise-corrected) spectrum within the `freqs` range [hz] of
+    that component, and the estimates are averaged, weighted by the
+    number of frequencies in each range. Components with a `freqs`
+    of None are not used. `freqs` and `noise` default to `eps_freqs`
+    and `spec_noise`.
+    """
+    if freqs is None:
+        freqs = eps_freqs
+    if noise is None:
+        noise = spec_noise
+    omega = bdat.omega
+    U = np.abs(bdat.U)
+    epstmp = np.zeros_like(bdat.u)
+    Ntmp = 0
+    for idx, frq_rng in enumerate(freqs):
+        if frq_rng is None:
+            continue
+        om_rng = np.asarray(frq_rng) * pii
+        inds = (om_rng[0] < omega) & (omega < om_rng[1])
+        N = inds.sum()
+        # Only the part of the spectrum in `om_rng` is used.
+        sptmp = np.maximum(bdat.Spec[idx][:, inds] - noise[idx] / pii, 0)
+        epstmp += bnr.calc_epsilon_LT83(sptmp, omega[inds], U,
+                                        om_rng) * N
+        Ntmp += N
+    epstmp /= Ntmp
+    # epstmp[np.abs(dat.U) < 0.2] = np.NaN
+    return epstmp
+
+
+def _calc_spectra(bnr, dat, bdat):
 
     # This is just a shortcut
     velmot = dat.velacc + dat.velrot
 
-    bdat = bnr(dat)
-
     # Calculate spectra ####
     bdat.add_data('Spec_velrot',
                   bnr.calc_vel_psd(dat.velrot, ),
@@ -200,7 +803,6 @@ def average(dat):
                   'spec')
 
     # Calculate cross-spectra ('point cross-spectra') ####
-    bdat.props['Cspec_comp'] = ['uv', 'uw', 'vw']
     bdat.add_data('Cspec_vel',
                   bnr.calc_vel_cpsd(dat.vel).astype(np.complex64),
                   'spec')
@@ -211,41 +813,67 @@ def average(dat):
                   bnr.calc_vel_cpsd(dat.velraw).astype(np.complex64),
                   'spec')
 
-    # Calculate triple products ####
-    # setup
-    bdat.props['tripprod_comp'] = [['uuu', 'uuv', 'uuw', ],
-                                   ['vvu', 'vvv', 'vvw', ],
-                                   ['wwu', 'wwv', 'www', ]]
-    bdat.add_data('tripprod',
-                  np.empty((3, 3, len(bdat.u)),
-                           dtype=np.float32),
-                  'turb')
-    # Calculate
-    turb = bnr.demean(dat.vel)
-    for i0 in range(3):
-        for i1 in range(3):
-            bdat.tripprod[i0, i1] = (turb[i0] ** 2 * turb[i1]).mean(-1)
 
-    # Calculate the dissipation rate ####
-    epstmp = np.zeros_like(bdat.u)
-    Ntmp = 0
-    for idx, frq_rng in enumerate(eps_freqs):
-        if frq_rng is None:
-            continue
-        om_rng = frq_rng * pii
-        N = ((om_rng[0] < bdat.omega) & (bdat.omega < om_rng[1])).sum()
-        sptmp = bdat.Spec[idx] - spec_noise[idx] / pii
-        sptmp[sptmp < 0] = 0
-        tmp = bnr.calc_epsilon_LT83(sptmp,
-                                    bdat.omega,
-                                    np.abs(bdat.U),
-                                    om_rng)
-        epstmp += tmp * N
-        Ntmp += N
-    epstmp /= Ntmp
-    # epstmp[np.abs(dat.U) < 0.2] = np.NaN
-    bdat.add_data('epsilon', epstmp, 'main')
-    return bdat
+def _calc_spectra_fused(bnr, dat, bdat):
+    # DOLfYN pads the bins differently for the auto- and the
+    # cross-spectra, so each signal is FFT'd once for each (and all
+    # of the spectra of a kind come from the same FFTs).
+    n_fft = int(bnr.n_fft)
+    auto = spectra.FusedSpectra(bnr.n_bin, bnr.fs, n_fft,
+                                min(int(bnr.n_bin) - n_fft, n_fft))
+    cross = spectra.FusedSpectra(bnr.n_bin, bnr.fs, n_fft, n_fft)
+
+    # Calculate spectra ####
+    velrot, velacc, velraw = auto.fft(
+        np.stack([dat.velrot, dat.velacc, dat.velraw]))
+    bdat.add_data('Spec_velrot', auto.psd(velrot), 'spec')
+    bdat.add_data('Spec_velacc', auto.psd(velacc), 'spec')
+    bdat.add_data('Spec_velmot', auto.psd(velacc + velrot), 'spec')
+    bdat.add_data('Spec_velraw', auto.psd(velraw), 'spec')
+
+    # Calculate cross-spectra ('point cross-spectra') ####
+    velrot, velacc, velraw, vel = cross.fft(
+        np.stack([dat.velrot, dat.velacc, dat.velraw, dat.vel]))
+    bdat.add_data('Cspec_vel', cross.cpsd(vel), 'spec')
+    bdat.add_data('Cspec_velmot', cross.cpsd(velacc + velrot), 'spec')
+    bdat.add_data('Cspec_velraw', cross.cpsd(velraw), 'spec')
+
+
+def average_h5(fname, principal=False):
+    """Average the data in the hdf5 file `fname`, `bins_per_block`
+    bins at a time.
+
+    The cross-spectra of a bin use the data of the bins next to it
+    (see `spectra`), so each block is read along with the bins on
+    either side of it, which are then dropped. This gives the same
+    result as ``average(avm.load(fname))`` without ever holding the
+    whole record in memory.
+
+    Parameters
+    ----------
+    fname : string
+       The (``_earth.h5``) file to average.
+    principal : bool
+       Rotate each block into the principal frame (of the whole file,
+       see `pax.cached_angle`) before averaging it.
+    """
+    rdr = dtbx.H5Reader(fname)
+    n_bin = int(5 * 60 * rdr.fs)
+    n_bins = len(rdr) // n_bin
+    if principal:
+        angle = pax.cached_angle(fname)
+    bdats = []
+    for k0 in range(0, n_bins, bins_per_block):
+        k1 = min(k0 + bins_per_block, n_bins)
+        j0, j1 = max(k0 - 1, 0), min(k1 + 1, n_bins)
+        blk = rdr.block(slice(j0 * n_bin, j1 * n_bin))
+        if principal:
+            pax.rotate_principal(blk, angle)
+        bdats.append(dtbx.time_slice(average(blk),
+                                     slice(k0 - j0, k1 - j0)))
+    rdr.close()
+    return dtbx.concat(bdats)
+
 
 if __name__ == '__main__':
 
@@ -268,10 +896,53 @@ if __name__ == '__main__':
         '--savecsv',
         help="Save simplified CSV files during processing?",
         action='store_true')
+    parser.add_argument(
+        '--force',
+        help="Recompute every processing stage, even if its output "
+        "is up to date.",
+        action='store_true')
+    parser.add_argument(
+        '--outofcore',
+        help="Average the data one block of bins at a time, rather "
+        "than loading the whole record into memory.",
+        action='store_true')
+    parser.add_argument(
+        '--storage', default=None,
+        choices=sorted(dtbx.storage_profiles.keys()),
+        help="The hdf5 storage profile of the output files (default: "
+        "'{}').".format(dtbx.storage_profile))
+    parser.add_argument(
+        '--mat73',
+        help="Save the _earth.mat files in MATLAB's v7.3 (hdf5) "
+        "format.",
+        action='store_true')
+    parser.add_argument(
+        '--incremental',
+        help="Only process the data that has been added to the .vec "
+        "files since the last incremental run, and append it to the "
+        "_earth.h5 and _earth_b5m.h5 files.",
+        action='store_true')
+    parser.add_argument(
+        '--report', default=None,
+        help="The JSON file to write the timing of each stage to "
+        "(default: a new file in ADV/timing/).")
+    parser.add_argument(
+        '--profile', default=None,
+        help="Save a cProfile of each stage to this directory.")
+    parser.add_argument(
+        '--jobs', type=int, default=None,
+        help="The number of processes to use. By default the files "
+        "are processed one at a time.")
     args = parser.parse_args()
     if not args.readvec:
         args.readvec = None
     if len(args.fnames) == 0:
-        args.fnames = FNAMES.values()
-
-    run(args.fnames, readvec=args.readvec, savecsv=args.savecsv)
+        finfo = FILEINFO.values()
+    else:
+        finfo = [finf for finf in FILEINFO.values()
+                 if finf.fname.split('/')[-1] in args.fnames]
+
+    run(finfo, readvec=args.readvec, savecsv=args.savecsv,
+        workers=args.jobs, force=args.force, outofcore=args.outofcore,
+        storage=args.storage, mat73=args.mat73, report=args.report,
+        profile=args.profile, incremental=args.incremental)
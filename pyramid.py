@@ -0,0 +1,245 @@
+"""
+Decimated min/max 'pyramids' of the velocity, for fast time-series
+plots.
+
+A day of 16 Hz data has about 1.4 million points per component, but
+a plot is only a few thousand pixels wide. Each level of a pyramid
+stores the minimum and maximum of the velocity in bins of
+`base_factor`, ``base_factor * level_factor``, ... samples. Plotting
+the (min, max) pairs of a level with at least one bin per pixel
+draws the same line as the full data, with a fraction of the
+points::
+
+    pyr = pyramid.cached(fname, 'pax')
+    pyr.plot(ax, 0)  # Plot u, at the right level for `ax`.
+
+Zoomed-in time ranges, that have fewer samples than pixels (times
+`oversample`), are read from the data file itself.
+
+The pyramid of each earth-frame file is built once, and stored in
+``<fname>.pyramid-<coordsys>.npz`` along with the hash of the file.
+"""
+from os.path import isfile
+import numpy as np
+import matplotlib as mpl
+import filetools as ftbx
+import dattools as dtbx
+import pax
+
+# The size (in samples) of the bins of the finest level, the factor
+# between levels, and the number of levels.
+base_factor = 8
+level_factor = 4
+n_levels = 6
+
+# The minimum number of bins (or samples) per pixel in a plot.
+oversample = 2
+
+
+def _minmax(vel, idx):
+    # The min and max of `vel` in the bins that start at `idx`
+    # (ignoring NaNs).
+    return (np.fmin.reduceat(vel, idx, axis=-1),
+            np.fmax.reduceat(vel, idx, axis=-1))
+
+
+def _center(mpltime, idx):
+    # The time of the center of the bins that start at `idx`.
+    last = np.append(idx[1:], len(mpltime)) - 1
+    return (mpltime[idx] + mpltime[last]) / 2
+
+
+def build(fname, coordsys='earth', n_block=2 ** 18):
+    """Build the min/max pyramid of the velocity in the earth-frame
+    hdf5 file `fname`.
+
+    The file is read in blocks of `n_block` samples. If `coordsys` is
+    'pax', the velocity is rotated into the principal frame (see
+    `pax.cached_angle`).
+    """
+    if coordsys not in ['earth', 'pax']:
+        raise Exception("The coordsys must be 'earth' or 'pax'.")
+    n_block -= n_block % base_factor
+    rdr = dtbx.H5Reader(fname)
+    try:
+        angle = None
+        if coordsys == 'pax':
+            angle = pax.cached_angle(fname)
+        n = len(rdr)
+        mpltime, vmin, vmax = [], [], []
+        for i0 in range(0, n, n_block):
+            indx = slice(i0, min(i0 + n_block, n))
+            vel = rdr.read('vel', indx)
+            if angle is not None:
+                pax.rotate_vec(vel, angle)
+            idx = np.arange(0, vel.shape[-1], base_factor)
+            mn, mx = _minmax(vel, idx)
+            mpltime.append(_center(rdr.mpltime[indx], idx))
+            vmin.append(mn)
+            vmax.append(mx)
+        fs = rdr.fs
+    finally:
+        rdr.close()
+    pyr = Pyramid(fname, coordsys, fs, n)
+    pyr.levels = [(np.concatenate(mpltime), np.concatenate(vmin, -1),
+                   np.concatenate(vmax, -1))]
+    for ilev in range(1, n_levels):
+        mpltime, mn, mx = pyr.levels[-1]
+        idx = np.arange(0, len(mpltime), level_factor)
+        pyr.levels.append((_center(mpltime, idx), ) + (
+            np.fmin.reduceat(mn, idx, axis=-1),
+            np.fmax.reduceat(mx, idx, axis=-1)))
+    return pyr
+
+
+def _key(fname, coordsys):
+    angle = None
+    if coordsys == 'pax':
+        angle = pax.cached_angle(fname)
+    return ftbx.stage_key('pyramid', ftbx.cached_sha(fname), coordsys,
+                          angle, base_factor, level_factor, n_levels)
+
+
+def cached(fname, coordsys='earth'):
+    """The `Pyramid` of the earth-frame hdf5 file `fname`.
+
+    The pyramid is only built if `fname` has changed since it was
+    last built.
+    """
+    cache_fname = '{}.pyramid-{}.npz'.format(fname, coordsys)
+    key = _key(fname, coordsys)
+    if isfile(cache_fname):
+        pyr = Pyramid.load(cache_fname)
+        if pyr.key == key:
+            pyr.fname = fname
+            return pyr
+    pyr = build(fname, coordsys)
+    pyr.key = key
+    pyr.save(cache_fname)
+    return pyr
+
+
+def pixel_width(ax, dpi=None):
+    """The width of the axes `ax` in pixels, at `dpi` (default: the
+    larger of the figure's and the savefig dpi)."""
+    fig = ax.figure
+    if dpi is None:
+        dpi = fig.dpi
+        if isinstance(mpl.rcParams['savefig.dpi'], (int, float)):
+            dpi = max(dpi, mpl.rcParams['savefig.dpi'])
+    return int(np.ceil(ax.get_position().width * fig.get_figwidth() * dpi))
+
+
+class Pyramid(object):
+    """The min/max pyramid of the velocity in a data file (see
+    `build`).
+
+    Attributes
+    ----------
+    fname : string
+       The data file.
+    coordsys : {'earth', 'pax'}
+       The coordinate system of the velocity.
+    fs : float
+       The sample rate of the data file.
+    n : int
+       The number of samples in the data file.
+    levels : list of (mpltime, vmin, vmax) tuples
+       The time of the center of each bin, and the minimum and maximum
+       of the velocity (shape ``(3, n_bins)``) in each bin, from the
+       finest to the coarsest level.
+    """
+
+    def __init__(self, fname, coordsys, fs, n):
+        self.fname = fname
+        self.coordsys = coordsys
+        self.fs = fs
+        self.n = n
+        self.levels = []
+        self.key = None
+        self._raw = (None, None)
+
+    @property
+    def factors(self, ):
+        """The number of samples in the bins of each level."""
+        return [base_factor * level_factor ** ilev
+                for ilev in range(len(self.levels))]
+
+    @property
+    def time_range(self, ):
+        return [self.levels[0][0][0], self.levels[0][0][-1]]
+
+    def select(self, time_range=None, n_px=1000):
+        """The coarsest data that has at least `oversample` points per
+        pixel in a plot of `time_range` that is `n_px` pixels wide.
+
+        Returns ``(mpltime, vel)``. For a level of the pyramid, these
+        are the bin times (each repeated twice), and the alternating
+        minimum and maximum of the velocity in each bin. Otherwise,
+        they are the data in the file.
+        """
+        if time_range is None:
+            time_range = self.time_range
+        time_range = dtbx.to_mpltime(time_range)
+        n_samp = (time_range[1] - time_range[0]) * 86400 * self.fs
+        for factor, (mpltime, vmin, vmax) in reversed(list(zip(
+                self.factors, self.levels))):
+            if n_samp / factor < oversample * n_px:
+                continue
+            # Include the bins that overlap the ends of the range.
+            i0, i1 = np.searchsorted(mpltime, time_range)
+            indx = slice(max(i0 - 1, 0), i1 + 1)
+            vel = np.empty(vmin.shape[:-1] + (2 * len(mpltime[indx]), ),
+                           dtype=vmin.dtype)
+            vel[..., 0::2] = vmin[..., indx]
+            vel[..., 1::2] = vmax[..., indx]
+            return np.repeat(mpltime[indx], 2), vel
+        return self._read(time_range)
+
+    def _read(self, time_range):
+        # Read the time_range of the data file (and keep it, so that
+        # each component of a plot does not read it again).
+        if self._raw[0] != list(time_range):
+            rdr = dtbx.H5Reader(self.fname)
+            try:
+                indx = rdr.index(time_range)
+                vel = rdr.read('vel', indx)
+                mpltime = rdr.mpltime[indx]
+            finally:
+                rdr.close()
+            if self.coordsys == 'pax':
+                pax.rotate_vec(vel, pax.cached_angle(self.fname))
+            self._raw = (list(time_range), (mpltime, vel))
+        return self._raw[1]
+
+    def plot(self, ax, comp, time_range=None, n_px=None, **kwargs):
+        """Plot the component `comp` of the velocity on the axes `ax`,
+        using the level that fits the width of `ax` (or `n_px`)."""
+        if n_px is None:
+            n_px = pixel_width(ax)
+        mpltime, vel = self.select(time_range, n_px)
+        return ax.plot(mpltime, vel[comp], **kwargs)
+
+    def save(self, fname):
+        """Save the pyramid to the .npz file `fname`."""
+        out = {'info': np.array([self.fname, self.coordsys, str(self.key)]),
+               'fs': self.fs, 'n': self.n, }
+        for ilev, (mpltime, vmin, vmax) in enumerate(self.levels):
+            out['mpltime/{}'.format(ilev)] = mpltime
+            out['min/{}'.format(ilev)] = vmin
+            out['max/{}'.format(ilev)] = vmax
+        np.savez(fname, **out)
+
+    @classmethod
+    def load(cls, fname):
+        """Load a pyramid that was saved with `save`."""
+        with np.load(fname) as dat:
+            data_fname, coordsys, key = [str(val) for val in dat['info']]
+            out = cls(data_fname, coordsys, float(dat['fs']), int(dat['n']))
+            out.key = key
+            ilev = 0
+            while 'mpltime/{}'.format(ilev) in dat.files:
+                out.levels.append(tuple(dat['{}/{}'.format(nm, ilev)]
+                                        for nm in ['mpltime', 'min', 'max']))
+                ilev += 1
+        return out
@@ -3,7 +3,19 @@ from process_adv import run as process
 import ttmlean
 
 if __name__ == '__main__':
-    pull(FILEINFO.values())
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Download and process the data files.")
+    parser.add_argument(
+        '--verify-full',
+        help="Rehash the source files that are already downloaded, "
+        "even if they haven't changed since they were last hashed.",
+        action='store_true')
+    args = parser.parse_args()
+
+    pull(FILEINFO.values(), verify_full=args.verify_full)
 
     process(FILEINFO.values())
 
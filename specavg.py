@@ -0,0 +1,173 @@
+"""
+Conditional averages of binned spectra, in ranges of the flow speed.
+
+`SpecAvg` averages every spectral variable of a binned data object
+(e.g., ``Spec``, ``Spec_velraw``, with shape ``(3, n_bins, n_freq)``)
+over the bins whose speed (``|u|``) is in each of several ranges. The
+range of each bin is found once (with ``searchsorted``), and the sums
+over all of the ranges are one matrix product per variable::
+
+    savg = SpecAvg(datbd, [(0, 0.5), (1, 1.5), (2, 2.5)])
+    savg.mean['Spec'][0, 1]  # The mean u-spectrum for 1 < |u| <= 1.5
+
+`from_file` caches the averages of a binned data file on disk.
+"""
+from os.path import isfile
+import numpy as np
+import dattools as dtbx
+import filetools as ftbx
+
+
+def spec_names(dat):
+    """The names of the spectral variables (``Spec*``) in `dat`."""
+    return [nm for nm, d in dat.iter() if nm.startswith('Spec')]
+
+
+class SpecAvg(object):
+    """Average the spectra of the binned data `datbd` in ranges of u.
+
+    Parameters
+    ----------
+    datbd : binned data object
+       The data (with ``u``, ``freq`` and the spectra).
+    ranges : list of (lo, hi) pairs
+       The ranges of u. These do not need to be contiguous or in
+       order (use ``zip(edges[:-1], edges[1:])`` for contiguous
+       ranges).
+    names : list of strings (optional)
+       The spectral variables to average (default: `spec_names`).
+    u_abs : bool
+       Use the speed, ``|u|``, instead of u.
+    closed : {'right', 'left', 'both', 'neither'}
+       Which ends of the ranges are included.
+    z : float
+       The half-width of the confidence intervals (`ci`) in standard
+       errors (1.96 is 95%).
+
+    Attributes
+    ----------
+    count : array (n_ranges)
+       The number of bins in each range.
+    mean, std : dicts of arrays (3, n_ranges, n_freq)
+       The mean and standard deviation of each spectral variable.
+       These are NaN if any of the bins in the range is NaN.
+    """
+
+    def __init__(self, datbd, ranges, names=None, u_abs=True,
+                 closed='right', z=1.96):
+        self.ranges = np.asarray(ranges, dtype=np.float64)
+        self.closed = closed
+        self.u_abs = u_abs
+        self.z = z
+        if names is None:
+            names = spec_names(datbd)
+        self.names = list(names)
+        self.freq = np.asarray(datbd.freq)
+        u = np.asarray(datbd.u)
+        if u_abs:
+            u = np.abs(u)
+        weights = self.weights(u)
+        self.count = weights.sum(-1).astype(np.int64)
+        self.mean = {}
+        self.std = {}
+        for nm in self.names:
+            self.mean[nm], self.std[nm] = self._average(
+                np.asarray(datbd[nm]), weights)
+
+    def weights(self, u):
+        """The (n_ranges, n_bins) array that is 1 where the bin is in
+        the range, and 0 elsewhere."""
+        edges = np.unique(self.ranges)
+        # The category of each value of u is 2k+1 if it is equal to
+        # edges[k], and 2k if it is between edges[k-1] and edges[k].
+        k = np.searchsorted(edges, u)
+        on_edge = edges[np.minimum(k, len(edges) - 1)] == u
+        cat = 2 * k + on_edge
+        # The first and last category in each range.
+        c0 = 2 * np.searchsorted(edges, self.ranges[:, 0]) + 2
+        c1 = 2 * np.searchsorted(edges, self.ranges[:, 1])
+        if self.closed in ('left', 'both'):
+            c0 -= 1
+        if self.closed in ('right', 'both'):
+            c1 += 1
+        return ((c0[:, None] <= cat) &
+                (cat <= c1[:, None])).astype(np.float64)
+
+    def _average(self, spec, weights):
+        isnan = np.isnan(spec)
+        spec = np.where(isnan, 0, spec).astype(np.float64)
+        # Sum over the bins (axis -2 of spec) for each range.
+        tot = np.einsum('rb,...bf->...rf', weights, spec)
+        tot2 = np.einsum('rb,...bf->...rf', weights, spec ** 2)
+        nnan = np.einsum('rb,...bf->...rf', weights, isnan)
+        n = self.count[:, None].astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = tot / n
+            var = (tot2 - n * mean ** 2) / (n - 1)
+        std = np.sqrt(np.maximum(var, 0))
+        mean[nnan > 0] = np.NaN
+        std[nnan > 0] = np.NaN
+        return mean, std
+
+    def ci(self, name):
+        """The (lower, upper) confidence interval of the mean of the
+        variable `name`."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            err = self.z * self.std[name] / np.sqrt(self.count[:, None])
+        return self.mean[name] - err, self.mean[name] + err
+
+    def save(self, fname):
+        """Save the averages to the .npz file `fname`."""
+        out = {'ranges': self.ranges, 'freq': self.freq,
+               'count': self.count,
+               'opts': np.array([self.closed, str(self.u_abs),
+                                 str(self.z)]), }
+        for nm in self.names:
+            out['mean/' + nm] = self.mean[nm]
+            out['std/' + nm] = self.std[nm]
+        np.savez(fname, **out)
+
+    @classmethod
+    def load(cls, fname):
+        """Load averages that were saved with `save`."""
+        out = cls.__new__(cls)
+        with np.load(fname) as dat:
+            out.ranges = dat['ranges']
+            out.freq = dat['freq']
+            out.count = dat['count']
+            closed, u_abs, z = dat['opts']
+            out.closed, out.u_abs, out.z = (str(closed), u_abs == 'True',
+                                            float(z))
+            out.names = sorted(ky.split('/', 1)[1] for ky in dat.files
+                               if ky.startswith('mean/'))
+            out.mean = dict((nm, dat['mean/' + nm]) for nm in out.names)
+            out.std = dict((nm, dat['std/' + nm]) for nm in out.names)
+        return out
+
+
+def from_file(fname, ranges, names=None, u_abs=True, closed='right',
+              cache=True):
+    """The `SpecAvg` of the binned data file `fname`.
+
+    Only ``vel``, ``freq`` and the spectra in `names` are read from
+    the file. If `cache` is True, the result is saved next to the
+    file, and reused as long as the file and the parameters are
+    unchanged.
+    """
+    rdr = dtbx.H5Reader(fname)
+    try:
+        if names is None:
+            names = spec_names(rdr.dat)
+        key = ftbx.stage_key('specavg', ftbx.cached_sha(fname),
+                             np.asarray(ranges, dtype=np.float64),
+                             list(names), u_abs, closed)
+        cache_fname = '{}.specavg-{}.npz'.format(fname, key)
+        if cache and isfile(cache_fname):
+            return SpecAvg.load(cache_fname)
+        dat = dtbx.LazyData(rdr, names=list(names) + ['vel', 'freq'])
+        savg = SpecAvg(dat, ranges, names, u_abs, closed)
+    finally:
+        rdr.close()
+    if cache:
+        savg.save(cache_fname)
+    return savg
@@ -0,0 +1,134 @@
+"""
+A spectral engine that computes all of the auto- and cross-spectra
+of several velocity signals from a single FFT of each signal.
+
+The spectra are computed the same way as DOLfYN's ``TimeBinner.psd``
+and ``cpsd`` (i.e., ``TurbBinner.calc_vel_psd`` and
+``calc_vel_cpsd``): each bin is padded with `n_pad` / 2 points from
+each of the neighbouring bins (zeros at the ends of the record), and
+split into (at least 50% overlapping) segments of length `n_fft` that
+are linearly detrended and Hann-windowed (``np.hanning``) before they
+are FFT'd. The DC component is dropped, and the spectra are in 'rad/s'
+units (i.e., the frequency is ``omega``).
+
+Detrending, windowing and the FFT are all linear, so the FFT of a
+sum of signals (e.g., ``velmot = velacc + velrot``) is the sum of
+their FFTs.
+"""
+import numpy as np
+
+pii = 2 * np.pi
+
+# The component pairs of the cross-spectra.
+cspec_pairs = [(0, 1), (0, 2), (1, 2)]
+
+
+def detrend(dat):
+    """Remove the linear trend along the last axis of `dat`."""
+    n = dat.shape[-1]
+    x = np.arange(n, dtype=dat.dtype) - (n - 1) / 2.
+    dat = dat - dat.mean(-1)[..., None]
+    slope = np.dot(dat, x) / np.dot(x, x)
+    dat -= slope[..., None] * x
+    return dat
+
+
+def stepsize(n, n_fft):
+    """The spacing and number of the FFT segments of a length `n`
+    array, as in DOLfYN's ``_stepsize``: the segments span the whole
+    array, with the fewest segments that overlap by at least 50%.
+
+    Returns ``(step, n_seg)``.
+    """
+    if n <= n_fft:
+        return 0, 1
+    n_seg = int(2. * n / n_fft)
+    return int((n - n_fft) / (n_seg - 1)), n_seg
+
+
+class FusedSpectra(object):
+    """Compute spectra from the FFTs of binned data.
+
+    Parameters
+    ----------
+    n_bin : int
+       The number of points in each bin.
+    fs : float
+       The sample rate [hz].
+    n_fft : int (default: `n_bin`)
+       The length of the FFT segments.
+    n_pad : int (default: 0)
+       The number of points from the neighbouring bins to add to each
+       bin. DOLfYN uses ``min(n_bin - n_fft, n_fft)`` for the
+       auto-spectra, and `n_fft` for the cross-spectra and coherence.
+    window : string
+       The window applied to each segment ('hann', or None).
+    """
+
+    def __init__(self, n_bin, fs, n_fft=None, n_pad=0, window='hann'):
+        self.n_bin = int(n_bin)
+        self.fs = fs
+        self.n_fft = int(n_fft or n_bin)
+        self.n_pad = int(n_pad)
+        self.step, self.n_seg = stepsize(self.n_bin + self.n_pad,
+                                         self.n_fft)
+        if window == 'hann':
+            self.window = np.hanning(self.n_fft)
+        elif window is None:
+            self.window = np.ones(self.n_fft)
+        else:
+            raise Exception("Invalid window: {}".format(window))
+        # Scale |fft|^2 to a one-sided spectrum in rad/s units.
+        self.scale = 2. / (self.window ** 2).sum() / self.fs / pii
+        self.window = self.window.astype(np.float32)
+
+    @property
+    def freq(self, ):
+        return np.arange(1, self.n_fft // 2 + 1) * self.fs / self.n_fft
+
+    @property
+    def omega(self, ):
+        return self.freq * pii
+
+    def segments(self, dat):
+        """Reshape `dat` (shape ``(..., N)``) into FFT segments of shape
+        ``(..., n_bins, n_seg, n_fft)``."""
+        nb = dat.shape[-1] // self.n_bin
+        npd0 = self.n_pad // 2
+        # The record, with zeros for the padding of the first and last
+        # bins.
+        pdat = np.zeros(dat.shape[:-1] + (nb * self.n_bin + self.n_pad, ),
+                        dtype=dat.dtype)
+        pdat[..., npd0:npd0 + nb * self.n_bin] = dat[..., :nb * self.n_bin]
+        inds = (np.arange(nb)[:, None, None] * self.n_bin +
+                np.arange(self.n_seg)[:, None] * self.step +
+                np.arange(self.n_fft))
+        return pdat[..., inds]
+
+    def fft(self, dat):
+        """FFT `dat` (shape ``(..., N)``).
+
+        Returns a complex64 array of shape
+        ``(..., n_bins, n_seg, n_freq)``.
+        """
+        seg = detrend(self.segments(np.asarray(dat, dtype=np.float32)))
+        seg *= self.window
+        return np.fft.rfft(seg, axis=-1)[..., 1:].astype(np.complex64)
+
+    def psd(self, fft):
+        """The auto-spectra of `fft` (the output of `self.fft`)."""
+        return ((fft.real ** 2 + fft.imag ** 2).mean(-2) *
+                self.scale).astype(np.float32)
+
+    def cpsd(self, fft):
+        """The cross-spectra ('uv', 'uw', 'vw') of the 3-component
+        `fft` (the output of `self.fft`)."""
+        return np.stack([(fft[i0] * fft[i1].conj()).mean(-2)
+                         for i0, i1 in cspec_pairs]) * \
+            np.complex64(self.scale)
+
+    def csd(self, fft_a, fft_b):
+        """The cross-spectra of the two signals `fft_a` and `fft_b`
+        (outputs of `self.fft`), i.e., ``fft_a * conj(fft_b)``."""
+        return ((fft_a * fft_b.conj()).mean(-2) *
+                np.complex64(self.scale))
@@ -0,0 +1,206 @@
+"""
+Synthetic IMU-equipped ADV data, for testing and benchmarking the
+processing tools without downloading the real data.
+
+`make_data` creates a DOLfYN data object that looks like a (cropped)
+Nortek Vector file as read by ``read_nortek``: 16 Hz velocity in the
+head frame, and the IMU's orientation matrix, angular rates and
+accelerations. The turbulence has a -5/3 spectrum, the mean flow
+is tidal, the ADV sways on a mooring, and the velocity contains
+spikes and out-of-range values. The data is statistically realistic,
+but it is not a physically exact model of a mooring.
+
+The metadata (``props``) comes from one of the ``userdata.json``
+files in ``ADV/``, e.g.::
+
+    import synthetic
+    dat = synthetic.make_data(hours=2)
+    synthetic.save(dat, 'ADV/synthetic')  # -> ADV/synthetic.h5
+"""
+import json
+import numpy as np
+from dolfyn.adv.base import ADVraw
+from filetools import pkg_root
+import dattools as dtbx
+
+# The metadata used by default.
+userdata_fname = pkg_root + 'ADV/ttm02b_ADVtop_NREL03_June2014.userdata.json'
+
+# The mean flow: ``u = tide_mean + tide_amp * sin(2 pi t / tide_period)``
+# [m/s] (the M2 tide, in hours).
+tide_mean = -0.8
+tide_amp = 1.3
+tide_period = 12.42
+
+# The standard deviation of the turbulence in each component, as a
+# fraction of the mean speed, and the frequency [hz] below which its
+# spectrum is flat (the largest eddies).
+turb_intensity = [0.10, 0.08, 0.05]
+turb_f0 = 0.02
+
+# The amplitude [deg] and frequency [hz] of the mooring sway.
+sway_amp = 3.
+sway_freq = 0.05
+
+g = 9.81
+
+
+def load_userdata(fname=userdata_fname):
+    """Load the metadata in the ``userdata.json`` file `fname` (with
+    ``time_range`` in mpltime, and the body2head arrays as
+    ``read_nortek`` loads them)."""
+    with open(fname) as f:
+        props = json.load(f)
+    if 'time_range' in props:
+        props['time_range'] = list(dtbx.to_mpltime(props['time_range']))
+    if props.get('body2head_rotmat') in ['identity', 'eye', 1, 1.]:
+        props['body2head_rotmat'] = np.eye(3)
+    for nm in ['body2head_rotmat', 'body2head_vec']:
+        if nm in props:
+            props[nm] = np.array(props[nm])
+    return props
+
+
+def red_noise(shape, fs, f0, rng, slope=-5. / 3):
+    """Random signals (of `shape`, along the last axis) with zero mean,
+    unit variance, and a spectrum that is proportional to
+    ``f ** slope`` above `f0` [hz] (and flat below it)."""
+    n = shape[-1]
+    f = np.fft.rfftfreq(n, 1. / fs)
+    amp = (f ** 2 + f0 ** 2) ** (slope / 4)
+    amp[0] = 0
+    spec = amp * (rng.standard_normal(shape[:-1] + f.shape) +
+                  1j * rng.standard_normal(shape[:-1] + f.shape))
+    out = np.fft.irfft(spec, n)
+    out /= out.std(-1)[..., None]
+    return out
+
+
+def euler2orient(heading, pitch, roll):
+    """The orientation matrix (shape ``(3, 3, N)``, body to earth) of
+    the `heading`, `pitch` and `roll` [radians]."""
+    ch, sh = np.cos(heading), np.sin(heading)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+    return np.array([
+        [ch * cp, ch * sp * sr - sh * cr, ch * sp * cr + sh * sr],
+        [sh * cp, sh * sp * sr + ch * cr, sh * sp * cr - ch * sr],
+        [-sp, cp * sr, cp * cr]])
+
+
+def body2mag(orientmat, declination=0):
+    """DOLfYN's ``orientmat`` (earth to inst, relative to magnetic
+    north) of the body-to-earth (true north) matrix `orientmat`.
+
+    ``read_nortek``'s orientmat is the transpose of the inst-to-earth
+    rotation, and it does not include the `declination` [degrees]
+    (which DOLfYN adds when it rotates the data to the earth frame).
+    """
+    cd = np.cos(-np.deg2rad(declination))
+    sd = np.sin(-np.deg2rad(declination))
+    rdec = np.array([[cd, -sd, 0],
+                     [sd, cd, 0],
+                     [0, 0, 1]])
+    return np.einsum('jin,jk->ikn', orientmat, rdec).astype(np.float32)
+
+
+def make_data(hours=1., fs=16., userdata=None, spike_frac=1e-3,
+              bad_frac=1e-4, seed=0):
+    """Create a synthetic ADV-IMU data object.
+
+    Parameters
+    ----------
+    hours : float
+       The length of the record.
+    fs : float
+       The sample rate [hz].
+    userdata : string or dict (optional)
+       The metadata: a ``userdata.json`` file, or its contents
+       (default: `userdata_fname`).
+    spike_frac : float
+       The fraction of the velocity data that are spikes (0.5-1.5
+       m/s, within the valid range).
+    bad_frac : float
+       The fraction of the velocity data that are out of range (3-5
+       m/s, see `process_adv.clean_limits`).
+    seed : int
+       The seed of the random numbers.
+    """
+    rng = np.random.RandomState(seed)
+    if userdata is None or isinstance(userdata, str):
+        props = load_userdata(userdata or userdata_fname)
+    else:
+        props = dict(userdata)
+    n = int(hours * 3600 * fs)
+    t0 = props.get('time_range', [735402.])[0]
+    mpltime = t0 + np.arange(n) / fs / 86400
+    props.update({'fs': fs,
+                  'coord_sys': 'inst',
+                  'inst_make': 'Nortek',
+                  'inst_model': 'VECTOR',
+                  'inst_type': 'ADV',
+                  # DOLfYN's ``dat.noise`` (as set by ``read_nortek``).
+                  'doppler_noise': [0, 0, 0],
+                  'rotate_vars': {'vel', 'AngRt', 'Accel'},
+                  'time_range': [mpltime[0], mpltime[-1] + 1 / fs / 86400],
+                  'synthetic': True, })
+    sec = np.arange(n) / fs
+
+    # The orientation: a constant heading, plus the mooring sway and
+    # some (smooth) random motion.
+    sway = np.deg2rad(sway_amp) * np.sin(
+        2 * np.pi * sway_freq * sec + rng.uniform(0, 2 * np.pi, (2, 1)))
+    jitter = np.deg2rad(0.5) * red_noise((3, n), fs, 0.1, rng, slope=-4)
+    heading = np.deg2rad(props.get('declination', 0)) + jitter[0]
+    pitch = sway[0] + jitter[1]
+    roll = sway[1] + jitter[2]
+    orientmat = euler2orient(heading, pitch, roll)
+
+    # The earth-frame velocity: a tidal mean flow plus turbulence,
+    # minus the motion of the ADV (the top of a 10 m mooring).
+    umean = tide_mean + tide_amp * np.sin(2 * np.pi * sec / 3600 /
+                                          tide_period)
+    vel = red_noise((3, n), fs, turb_f0, rng)
+    vel *= (np.abs(umean) * np.array(turb_intensity)[:, None])
+    vel[0] += umean
+    posmoor = 10. * orientmat[:, 2]
+    velmoor = np.gradient(posmoor, axis=-1) * fs
+    vel -= velmoor
+    # The accelerations are measured in the body frame, and the
+    # velocity in the head frame.
+    vel = np.einsum('jin,jn->in', orientmat, vel)
+    vel = np.dot(np.asarray(props['body2head_rotmat']), vel)
+    accel = np.gradient(velmoor, axis=-1) * fs
+    accel[2] += g
+    accel = np.einsum('jin,jn->in', orientmat, accel)
+    accel += 0.01 * rng.standard_normal((3, n))
+    angrt = np.gradient(np.array([roll, pitch, heading]), axis=-1) * fs
+
+    # Spikes and out-of-range values.
+    for frac, lims in [(spike_frac, (0.5, 1.5)), (bad_frac, (3, 5))]:
+        inds = rng.randint(0, n, (3, int(frac * n)))
+        for comp, ind in enumerate(inds):
+            vel[comp, ind] += (rng.choice([-1, 1], len(ind)) *
+                               rng.uniform(lims[0], lims[1], len(ind)))
+
+    dat = ADVraw()
+    dat.props = props
+    dat.add_data('mpltime', mpltime, 'main')
+    dat.add_data('vel', vel.astype(np.float32), 'main')
+    dat.add_data('orientmat',
+                 body2mag(orientmat, props.get('declination', 0)), 'orient')
+    dat.add_data('AngRt', angrt.astype(np.float32), 'orient')
+    dat.add_data('Accel', accel.astype(np.float32), 'orient')
+    dat.add_data('heading', np.rad2deg(heading).astype(np.float32),
+                 'orient')
+    dat.add_data('pitch', np.rad2deg(pitch).astype(np.float32), 'orient')
+    dat.add_data('roll', np.rad2deg(roll).astype(np.float32), 'orient')
+    for nm, val in [('amp', 130), ('corr', 95)]:
+        dat.add_data(nm, np.full((3, n), val, dtype=np.uint8), 'signal')
+    return dat
+
+
+def save(dat, fname):
+    """Save `dat` to ``<fname>.h5``, like `process_adv._read_raw`
+    does for real data."""
+    dtbx.save(dat, fname + '.h5', int(5 * 60 * dat.props['fs']))
@@ -0,0 +1,192 @@
+"""
+Timing and resource-use instrumentation of the processing stages.
+
+Each stage of the processing is wrapped in a `stage` block::
+
+    with timing.stage('average'):
+        bdat = average(dat)
+
+which records the stage's wall time, CPU time, peak memory use (RSS)
+and the bytes it read and wrote (on Linux). `save_report` writes the
+records to a JSON file.
+
+Notes
+-----
+CPU time and bytes read/written are for the whole process, and the
+peak RSS is only reset when no other stage is running. For stages
+that run at the same time (e.g., in threads), these values are upper
+bounds. The bytes read/written include reads from the page cache.
+"""
+from __future__ import print_function
+import cProfile
+import json
+import os
+import platform
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+
+pkg_root = path.dirname(path.realpath(__file__)) + '/'
+
+# The directory that `save_report` writes to by default.
+report_dir = pkg_root + 'ADV/timing/'
+
+# The records of the stages that have run in this process (dicts).
+records = []
+
+# The file that is being processed (the 'file' of each record).
+current_file = None
+
+# If this is not None, a cProfile of each stage is saved to
+# ``<profile_dir>/<file>.<stage>.prof``.
+profile_dir = None
+
+# Print the timing of each stage when it finishes?
+verbose = True
+
+_lock = threading.Lock()
+_active = [0]
+_local = threading.local()
+
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _io():
+    # The bytes read and written by this process (Linux only).
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+    except (IOError, OSError):
+        return None
+    return int(io['rchar']), int(io['wchar'])
+
+
+def _reset_peak():
+    # Reset the peak RSS (Linux >= 4.0 only).
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _peak_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2. ** 10
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is the peak RSS since the process started (kB on
+    # Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10
+
+
+@contextmanager
+def stage(name, fname=None):
+    """Record the resource use of a block of code.
+
+    Parameters
+    ----------
+    name : string
+       The name of the stage (e.g., 'read', 'average').
+    fname : string (optional)
+       The file that is being processed (default: `current_file`).
+
+    The record (a dict) is the value of the ``with`` statement, so
+    that more information can be added to it.
+    """
+    rec = {'file': fname or current_file, 'stage': name}
+    with _lock:
+        if _active[0] == 0:
+            _reset_peak()
+        _active[0] += 1
+    prof = None
+    if profile_dir is not None and not getattr(_local, 'profiling', False):
+        # Only one profiler can run in a thread at a time.
+        prof = cProfile.Profile()
+        _local.profiling = True
+        prof.enable()
+    io0 = _io()
+    cpu0 = _cpu()
+    t0 = time.time()
+    rec['ok'] = False
+    try:
+        yield rec
+        rec['ok'] = True
+    finally:
+        rec['wall'] = time.time() - t0
+        rec['cpu'] = _cpu() - cpu0
+        rec['peak_rss_mb'] = _peak_mb()
+        io1 = _io()
+        if io0 is not None and io1 is not None:
+            rec['bytes_read'] = io1[0] - io0[0]
+            rec['bytes_written'] = io1[1] - io0[1]
+        if prof is not None:
+            prof.disable()
+            _local.profiling = False
+            if not path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            prof.dump_stats(path.join(profile_dir, '{}.{}.prof'.format(
+                path.basename(str(rec['file'])), name)))
+        with _lock:
+            _active[0] -= 1
+            records.append(rec)
+        if verbose:
+            print("  [{}: {:.1f} s wall, {:.1f} s cpu, {:.0f} MB peak]"
+                  .format(name, rec['wall'], rec['cpu'],
+                          rec['peak_rss_mb']))
+
+
+def totals(recs=None):
+    """The total wall time, CPU time and bytes read/written, and the
+    maximum peak RSS, of each stage in `recs` (default: `records`)."""
+    out = {}
+    for rec in records if recs is None else recs:
+        tot = out.setdefault(rec['stage'], {'count': 0, 'wall': 0.,
+                                            'cpu': 0., 'peak_rss_mb': 0.,
+                                            'bytes_read': 0,
+                                            'bytes_written': 0})
+        tot['count'] += 1
+        for ky in ['wall', 'cpu', 'bytes_read', 'bytes_written']:
+            tot[ky] += rec.get(ky, 0)
+        tot['peak_rss_mb'] = max(tot['peak_rss_mb'], rec['peak_rss_mb'])
+    return out
+
+
+def save_report(fname=None, name='run', info=None, recs=None):
+    """Write the `recs` (default: `records`) to the JSON file `fname`.
+
+    Parameters
+    ----------
+    fname : string (optional)
+       The report file (default:
+       ``<report_dir>/<name>-<YYYYmmdd-HHMMSS>.json``).
+    name : string
+       The name of the run.
+    info : dict (optional)
+       Information about the run (e.g., its parameters).
+
+    Returns the name of the file.
+    """
+    if recs is None:
+        recs = records
+    if fname is None:
+        fname = report_dir + '{}-{}.json'.format(
+            name, time.strftime('%Y%m%d-%H%M%S'))
+    if path.dirname(fname) and not path.isdir(path.dirname(fname)):
+        os.makedirs(path.dirname(fname))
+    with open(fname, 'w') as f:
+        json.dump({'name': name,
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'host': platform.node(),
+                   'info': info or {},
+                   'totals': totals(recs),
+                   'stages': recs, }, f, indent=1, default=str)
+    return fname
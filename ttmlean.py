@@ -2,8 +2,13 @@
 import scipy.signal as sig
 import matplotlib.pyplot as plt
 import numpy as np
+from multiprocessing import Pool
 import dolfyn.adv.api as avm
 from main import FILEINFO, pkg_root
+import dattools as dtbx
+import pax
+import specavg
+import timing
 
 
 def within(dat, minval, maxval):
@@ -20,33 +25,92 @@ l_adv_mooring = 10.0
 pii = 2 * np.pi
 
 
-def correct_motion(dat, filt_freq):
-
-    datmc = dat.copy()
-    avm.motion.correct_motion(datmc, accel_filtfreq=filt_freq)
-
-    moor2earth_rotmat = np.einsum(
-        'jik,jl,lm->imk',
-        datmc.orientmat,  # body2earth_rotmat (with transpose in index: ji)
-        datmc.props['body2head_rotmat'].T,  # head2body_rotmat
-        moor2head_rotmat)
-
+def mooring_kinematics(dat):
+    """Calculate the position and (unfiltered) velocity of the mooring.
+
+    These do not depend on the motion-correction filter frequency, so
+    they can be reused for several filter frequencies (see
+    `prepare_motion`).
+
+    Returns
+    -------
+    posmoor : array (3, N)
+    velmoor_nofilt : array (3, N)
+    """
+    # Only the mooring's z-axis (column 2 of moor2earth_rotmat) is
+    # needed, and head2body_rotmat * moor2head_rotmat is constant, so
+    # this is just body2earth_rotmat times the (body-frame) z-axis.
+    zvec_body = np.dot(np.asarray(dat.props['body2head_rotmat']).T,
+                       moor2head_rotmat[:, 2])
+    # orientmat is body2earth_rotmat with transpose in index: ji.
     # Multiply the mooring's z-vector, in the earth-frame, by the
     # length of the mooring to get the position of the mooring as a fn
     # of time.
-    datmc.add_data('posmoor',
-                   moor2earth_rotmat[:, 2] * l_adv_mooring,
-                   'orient')
+    posmoor = np.tensordot(zvec_body * l_adv_mooring, dat.orientmat,
+                           axes=(0, 0))
+
+    velmoor_nofilt = np.empty_like(posmoor)
+    np.subtract(posmoor[:, 1:], posmoor[:, :-1], out=velmoor_nofilt[:, :-1])
+    velmoor_nofilt[:, -1] = velmoor_nofilt[:, -2]
+    velmoor_nofilt *= dat.fs
+    return posmoor, velmoor_nofilt
+
+
+def filter_velmoor(velmoor_nofilt, fs, filt_freq, chunk=None):
+    """Low-pass filter the mooring velocity (zero-phase, 2nd order
+    Butterworth).
+
+    Parameters
+    ----------
+    velmoor_nofilt : array (3, N)
+    fs : float
+       The sample rate [hz].
+    filt_freq : float
+       The filter frequency [hz].
+    chunk : int (optional)
+       Filter the data `chunk` points at a time. Each chunk is
+       filtered with 10 / `filt_freq` seconds of overlap on each
+       side, so that it matches filtering the whole record (to within
+       the decay of the filter's transients).
+    """
+    filt = sig.butter(2, filt_freq / (fs / 2))
+    n = velmoor_nofilt.shape[-1]
+    if chunk is None or chunk >= n:
+        return sig.filtfilt(filt[0], filt[1], velmoor_nofilt)
+    pad = int(10 * fs / filt_freq)
+    out = np.empty_like(velmoor_nofilt)
+    for i0 in range(0, n, chunk):
+        i1 = min(i0 + chunk, n)
+        j0, j1 = max(i0 - pad, 0), min(i1 + pad, n)
+        out[:, i0:i1] = sig.filtfilt(filt[0], filt[1],
+                                     velmoor_nofilt[:, j0:j1]
+                                     )[:, i0 - j0:i1 - j0]
+    return out
+
+
+def correct_motion(dat, filt_freq, chunk=None):
+    """Motion correct `dat`, including the motion of the mooring.
+
+    Parameters
+    ----------
+    dat : ADV data object
+    filt_freq : float
+       The filter frequency [hz] of the motion correction.
+    chunk : int (optional)
+       Filter the mooring velocity in chunks of this many points (see
+       `filter_velmoor`).
+    """
+
+    # Only copy the variables that motion correction changes.
+    datmc = dtbx.cow_copy(dat, set(dat.props['rotate_vars']) | {'vel'})
+    avm.motion.correct_motion(datmc, accel_filtfreq=filt_freq)
 
-    datmc.add_data('velmoor_nofilt',
-                   np.pad(np.diff(datmc.posmoor) * datmc.fs,
-                          ([0, 0], [0, 1]),
-                          'edge'),
-                   'orient')
-    filt = sig.butter(2, filt_freq / (datmc.fs / 2))
+    posmoor, velmoor_nofilt = mooring_kinematics(datmc)
+    datmc.add_data('posmoor', posmoor, 'orient')
+    datmc.add_data('velmoor_nofilt', velmoor_nofilt, 'orient')
     datmc.add_data('velmoor',
-                   sig.filtfilt(filt[0], filt[1],
-                                datmc.velmoor_nofilt),
+                   filter_velmoor(velmoor_nofilt, datmc.fs, filt_freq,
+                                  chunk),
                    'orient')
     datmc.vel += datmc.velmoor  # Add velmoor to the vel
 
@@ -54,10 +118,105 @@ def correct_motion(dat, filt_freq):
     return datmc
 
 
+def prepare_motion(dat):
+    """Do the part of the motion correction of `dat` (`correct_motion`
+    and ``earth2principal``) that does not depend on the filter
+    frequency.
+
+    This is DOLfYN's ``correct_motion`` without the acceleration
+    terms: the velocity is rotated into the body frame, ``velrot`` is
+    calculated, the data is rotated into the earth frame and
+    ``velraw`` is saved. Then the mooring kinematics are added, and
+    the data is rotated into the principal frame. ``vel`` is
+    ``velraw + velrot``.
+
+    ``velacc`` and ``velmoor`` are high- and low-pass filtered, so the
+    principal angle is that of ``velraw + velrot``. This puts all of
+    the filter frequencies of a sweep in the same frame.
+
+    Returns
+    -------
+    prep : tuple
+       The input of `finish_motion`: the data object (in the principal
+       frame), and DOLfYN's ``CalcMotion`` object (which holds the
+       earth-frame acceleration).
+    """
+    rotate_vars = set(dat.props['rotate_vars'])
+    if dat.props.get('motion corrected', False) or \
+       dat.props['coord_sys'] != 'inst':
+        raise Exception("The data must be in the instrument frame, and "
+                        "not motion corrected.")
+    # The orientmat is rotated in place by `pax.rotate_principal`.
+    datp = dtbx.cow_copy(dat, rotate_vars | {'vel', 'orientmat'})
+    avm.rotate._rotate_vel2body(datp)
+    calcobj = avm.motion.CalcMotion(datp, to_earth=False)
+    datp.add_data('velrot',
+                  calcobj.calc_velrot(
+                      np.asarray(datp.props['body2head_vec']),
+                      to_earth=False),
+                  'orient')
+    datp.Accel = calcobj.Accel
+    avm.rotate.inst2earth(datp,
+                          rotate_vars=(rotate_vars | {'velrot'}) - {'Accel'})
+    datp.add_data('velraw', datp.vel.copy(), 'main')
+    datp.vel += datp.velrot
+
+    posmoor, velmoor_nofilt = mooring_kinematics(datp)
+    datp.add_data('posmoor', posmoor, 'orient')
+    datp.add_data('velmoor_nofilt', velmoor_nofilt, 'orient')
+    datp.props['rotate_vars'].update({'velrot', 'velraw', 'posmoor',
+                                      'velmoor_nofilt'})
+    pax.rotate_principal(datp, pax.principal_angle(datp.vel))
+    # ``velacc`` and ``AccelStable`` are filtered (per component) from
+    # the principal-frame Accel, so they are in the principal frame.
+    calcobj.Accel = datp.Accel
+    return datp, calcobj
+
+
+def finish_motion(prep, filt_freq, chunk=None):
+    """Motion correct the output of `prepare_motion` for the filter
+    frequency `filt_freq` [hz].
+
+    Only ``velacc`` (and ``AccelStable``) and ``velmoor`` are
+    calculated, and added to ``vel``. The output is in the principal
+    frame, and shares the filter-independent arrays with `prep`.
+
+    Parameters
+    ----------
+    prep : tuple
+       The output of `prepare_motion`.
+    filt_freq : float
+       The filter frequency [hz] of the motion correction.
+    chunk : int (optional)
+       Filter the mooring velocity in chunks of this many points (see
+       `filter_velmoor`).
+    """
+    datp, calcobj = prep
+    # As in DOLfYN's ``CalcMotion.__init__``.
+    calcobj.accel_filtfreq = filt_freq
+    calcobj.accelvel_filtfreq = filt_freq / 3.0
+    calcobj._set_AccelStable()
+
+    datmc = dtbx.cow_copy(datp, set())
+    datmc.add_data('velacc', calcobj.calc_velacc(), 'orient')
+    datmc.add_data('AccelStable', calcobj.AccelStable, 'orient')
+    datmc.add_data('velmoor',
+                   filter_velmoor(datp.velmoor_nofilt, datp.fs, filt_freq,
+                                  chunk),
+                   'orient')
+    datmc['vel'] = (datp.vel + datmc.velacc +
+                    datmc.velmoor).astype(datp.vel.dtype)
+
+    datmc.props['rotate_vars'].update({'velacc', 'AccelStable', 'velmoor'})
+    datmc.props['motion corrected'] = True
+    datmc.props['motion accel_filtfreq Hz'] = filt_freq
+    return datmc
+
+
 def bin(datnow):
 
     # 4800 points is 5min at 16hz
-    binner = avm.TurbBinner(5 * 60 * datnow.fs, datnow.fs)
+    binner = avm.TurbBinner(int(5 * 60 * datnow.fs), datnow.fs)
     datbd = binner(datnow)
     datbd.add_data('Spec_velraw', binner.psd(datnow.velraw), 'orient')
     datbd.add_data('Spec_velacc', binner.psd(datnow.velacc), 'orient')
@@ -107,30 +266,38 @@ def plot_bt_filt_spec(fignum, datbd):
                                              wspace=0.1),
                             sharex=True, sharey=True)
 
+    names = ['Spec', 'Spec_velraw', 'Spec_velmot', 'Spec_velrot',
+             'Spec_velacc']
+    if 'Spec_velmoor' in datbd:
+        names.append('Spec_velmoor')
+    # The ranges exclude both ends (like `within`).
+    savg = specavg.SpecAvg(datbd, vranges, names, closed='neither')
+    freq = savg.freq
+
     for icol, vrng in enumerate(vranges):
         axs = AXS[:, icol]
-        inds = within(np.abs(datbd.u), *vrng)
+        spec = dict((nm, savg.mean[nm][:, icol]) for nm in names)
         noise = [1e-5, 1e-5, 2e-6]
 
         for iax, ax in enumerate(axs):
-            ax.loglog(datbd.freq,
-                      (datbd.Spec[iax][inds].mean(0) - noise[iax]) * pii,
+            ax.loglog(freq,
+                      (spec['Spec'][iax] - noise[iax]) * pii,
                       'g', label='$u$', linewidth=2, zorder=10)
-            ax.loglog(datbd.freq,
-                      (datbd.Spec_velraw[iax][inds].mean(0) - noise[iax]) * pii,
+            ax.loglog(freq,
+                      (spec['Spec_velraw'][iax] - noise[iax]) * pii,
                       'y', label='$u_{raw}$')
-            ax.loglog(datbd.freq,
-                      datbd.Spec_velmot[iax][inds].mean(0) * pii,
+            ax.loglog(freq,
+                      spec['Spec_velmot'][iax] * pii,
                       'k', label='$u_{mot}$', zorder=8, linewidth=1.5)
-            ax.loglog(datbd.freq,
-                      datbd.Spec_velrot[iax][inds].mean(0) * pii,
+            ax.loglog(freq,
+                      spec['Spec_velrot'][iax] * pii,
                       'm', label='$u_{rot}$')
-            ax.loglog(datbd.freq,
-                      datbd.Spec_velacc[iax][inds].mean(0) * pii,
+            ax.loglog(freq,
+                      spec['Spec_velacc'][iax] * pii,
                       'b', label='$u_{acc}$')
-            if 'Spec_velmoor' in datbd:
-                ax.loglog(datbd.freq,
-                          datbd.Spec_velmoor[iax][inds].mean(0) * pii,
+            if 'Spec_velmoor' in spec:
+                ax.loglog(freq,
+                          spec['Spec_velmoor'][iax] * pii,
                           'r', label='$u_{moor}$')
             ax.plot(line['x'], line['y'], 'k--')
             try:
@@ -157,17 +324,83 @@ filt_freqs = {'5s': 0.2,
               '30s': 0.03}
 
 
-def process(finf=FILEINFO['ttm02b-top']):
-
-    dat = avm.load(finf.abs_fname + '.h5')
-
-    for filt_tag, filt_freq in filt_freqs.iteritems():
-
-        datmc = correct_motion(dat, filt_freq)
-        datpx = datmc.copy()
-        avm.rotate.earth2principal(datpx)
-        datbd = bin(datpx)
-        datbd.save(finf.abs_fname + '_velmoor-f{}_b5m.h5'.format(filt_tag))
+# The data shared with the `sweep` worker processes.
+_sweep_data = {}
+
+
+def _sweep_one(filt_freq):
+    # Returns the binned data, and the timing records of its stages
+    # (which are lost with the worker process otherwise).
+    nrec = len(timing.records)
+    with timing.stage('motion') as rec:
+        rec['filt_freq'] = filt_freq
+        datmc = finish_motion(_sweep_data['prep'], filt_freq)
+    with timing.stage('average') as rec:
+        rec['filt_freq'] = filt_freq
+        datbd = bin(datmc)
+    return datbd, timing.records[nrec:]
+
+
+def sweep(finf=FILEINFO['ttm02b-top'], filt_freqs=filt_freqs, workers=None):
+    """Motion correct, rotate and bin the data in `finf` for each of
+    several filter frequencies.
+
+    The filter-independent part of the motion correction (see
+    `prepare_motion`) is only done once. If `workers` is
+    not None, the filter frequencies are processed in that many
+    processes (this requires a platform that forks, e.g. Linux).
+
+    Returns
+    -------
+    datbd : dict
+       The binned data for each entry of `filt_freqs`.
+    """
+    timing.current_file = finf.fname
+    with timing.stage('load'):
+        dat = avm.load(finf.abs_fname + '.h5')
+    with timing.stage('prepare'):
+        _sweep_data['prep'] = prepare_motion(dat)
+    tags = list(filt_freqs.keys())
+    freqs = [filt_freqs[tag] for tag in tags]
+    try:
+        if workers is None:
+            out = [_sweep_one(freq) for freq in freqs]
+        else:
+            pool = Pool(workers)
+            try:
+                out = pool.map(_sweep_one, freqs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _sweep_data.clear()
+    if workers is not None:
+        for datbd, recs in out:
+            timing.records.extend(recs)
+    return dict(zip(tags, [datbd for datbd, recs in out]))
+
+
+def process(finf=FILEINFO['ttm02b-top'], workers=None, report=None):
+    """Process the data in `finf` for each of the `filt_freqs`.
+
+    The timing of each stage is written to the JSON file `report`
+    (see `timing.save_report`; False: no report).
+    """
+    nrec = len(timing.records)
+    datbds = sweep(finf, filt_freqs, workers)
+    for filt_tag, datbd in datbds.items():
+        with timing.stage('save') as rec:
+            rec['filt_freq'] = filt_freqs[filt_tag]
+            dtbx.save(datbd,
+                      finf.abs_fname +
+                      '_velmoor-f{}_b5m.h5'.format(filt_tag))
+    if report is not False:
+        report = timing.save_report(
+            report, 'ttmlean',
+            info={'file': finf.fname, 'workers': workers,
+                  'filt_freqs': filt_freqs},
+            recs=timing.records[nrec:])
+        print("Timing report: {}".format(report))
 
 
 def make_pos_time_fig(finf=FILEINFO['ttm02b-top']):
@@ -181,7 +414,7 @@ def make_pos_time_fig(finf=FILEINFO['ttm02b-top']):
 def make_vel_spec_figs(finf=FILEINFO['ttm02b-top']):
 
     for idx, (filt_tag, filt_freq) in enumerate(
-            filt_freqs.iteritems()):
+            filt_freqs.items()):
         datbd = avm.load(finf.abs_fname +
                          '_velmoor-f{}_b5m.h5'.format(filt_tag))
         fig, AXS = plot_bt_filt_spec(300 + idx, datbd)